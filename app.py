@@ -1,20 +1,38 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 from email.message import EmailMessage
 import ssl
 import smtplib
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from PIL import Image
+import requests
+from tenacity import Retrying, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import time
 import shutil
+import io
+import queue
+import threading
+import atexit
+import fcntl
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import zipfile  # ← IMPORTACIÓN FALTANTE
+import jobs
+from manifest import MANIFEST_DB_PATH, DeliveryManifest
+from collections import deque
+import itertools
+from contextlib import contextmanager
+import json
+import re
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# Selenium y PIL se importan dentro de las funciones que los usan: Streamlit
+# re-ejecuta este script en cada interacción y solo una captura los necesita.
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("codigos_barras")
 
 # =========================================
 # Credenciales desde st.secrets
@@ -24,6 +42,8 @@ try:
     redcap_password = st.secrets["redcap_password"]
     email_sender = st.secrets["email_sender"]
     email_password = st.secrets["email_password"]
+    # Opcional: solo necesario para el motor sin navegador
+    redcap_api_token = st.secrets.get("redcap_api_token")
 except Exception as e:
     st.error("❌ Error al cargar los secretos. Por favor configura tus secretos de Streamlit.")
     st.stop()
@@ -31,9 +51,22 @@ except Exception as e:
 # =========================================
 # Opciones de Chrome para Entorno en la Nube
 # =========================================
-def get_chrome_options():
-    """Obtener opciones de Chrome optimizadas para entornos en la nube"""
+def get_chrome_options(lean=False, pipelined=False):
+    """Obtener opciones de Chrome optimizadas para entornos en la nube.
+
+    Con `lean` se usa la estrategia de carga "eager" (no espera imágenes ni
+    subrecursos; la detección de página lista espera solo los del código de barras).
+    Con `pipelined` la estrategia es "none": chromedriver no espera ninguna
+    navegación, así varias pestañas cargan a la vez y la espera la hace
+    _await_tab_barcode.
+    """
+    from selenium.webdriver.chrome.options import Options
+
     chrome_options = Options()
+    if pipelined:
+        chrome_options.page_load_strategy = "none"
+    elif lean:
+        chrome_options.page_load_strategy = "eager"
     
     # Opciones esenciales para entornos en la nube/sin cabeza
     chrome_options.add_argument("--headless=new")
@@ -69,153 +102,2067 @@ def get_chrome_options():
     return chrome_options
 
 # =========================================
-# Función de Captura de Pantalla de Códigos de Barras de RedCap
+# Perfil de Captura Liviano (CDP)
 # =========================================
-def download_barcode_images(record_ids, username, password):
-    """Descargar imágenes de códigos de barras para Record IDs específicos desde RedCap"""
-    driver = None
+# Recursos que no hacen falta para pintar tr#barcode-tr. Los patrones de
+# Network.setBlockedURLs admiten comodines; los tipos de recurso (fuentes,
+# medios) se bloquean por extensión. Se pueden agregar más desde secrets.
+LEAN_BLOCKED_URLS = [
+    # Fuentes
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    # Medios
+    "*.mp4", "*.webm", "*.mp3", "*.ogg",
+    # Analítica
+    "*google-analytics.com*", "*googletagmanager.com*", "*analytics.js*", "*matomo*", "*piwik*",
+] + list(st.secrets.get("lean_blocked_urls", []))
+
+def apply_lean_profile(driver):
+    """Bloquear por CDP los recursos innecesarios, manteniendo la caché HTTP activa"""
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setCacheDisabled", {"cacheDisabled": False})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+
+# Bytes transferidos por la página actual (documento + subrecursos, 0 si vino de caché)
+PAGE_TRANSFER_JS = """
+const entries = performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'));
+return entries.reduce((total, entry) => total + (entry.transferSize || 0), 0);
+"""
+
+# =========================================
+# URLs de RedCap
+# =========================================
+REDCAP_PROJECT_ID = 19
+REDCAP_EVENT_ID = 59
+# Configurable desde secrets para apuntar a otra instancia (p. ej. fake_redcap.py)
+REDCAP_BASE_URL = st.secrets.get("redcap_base_url", "https://redcap.prisma.org.pe/redcap_v14.5.11")
+LOGIN_URL = f"{REDCAP_BASE_URL}/DataEntry/record_status_dashboard.php?pid={REDCAP_PROJECT_ID}"
+TARGET_URL_TEMPLATE = (
+    f"{REDCAP_BASE_URL}/DataEntry/index.php?pid={REDCAP_PROJECT_ID}&id={{id_val}}"
+    f"&event_id={REDCAP_EVENT_ID}&page=recepcion_de_muestra"
+)
+REDCAP_API_URL = st.secrets.get("redcap_api_url", "https://redcap.prisma.org.pe/api/")
+# Campo del proyecto con el valor impreso en el código de barras. El motor API lo exige:
+# no hay un valor por defecto seguro (record_id solo sirve si la etiqueta imprime el ID).
+REDCAP_BARCODE_FIELD = st.secrets.get("redcap_barcode_field")
+REDCAP_API_EVENT = st.secrets.get("redcap_api_event")  # Nombre único del evento 59
+# RedCap interpreta dateRangeBegin en la hora local de su servidor, no en la de este contenedor
+REDCAP_TIMEZONE = ZoneInfo(st.secrets.get("redcap_timezone", "America/Lima"))
+# Margen hacia atrás para desfases de reloj entre servidores: consultar de más, nunca de menos
+REDCAP_CLOCK_MARGIN = 300
+BARCODE_CACHE_DIR = "cache_codigos_barras"
+# Intervalo mínimo (segundos) entre recorridos de la caché para aplicar su límite de tamaño
+CACHE_EVICT_INTERVAL = 1.0
+
+# =========================================
+# Instrumentación de la Captura
+# =========================================
+class CaptureMetrics:
+    """Tiempos por ID y etapa, y memoria del driver, de una ejecución de captura.
+
+    Las etapas generales (iniciar_chrome, login, zip, smtp) se registran sin
+    record_id. Es seguro usarla desde los hilos de captura.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = []  # {"record_id", "etapa", "segundos"}
+        self.memory = []  # {"record_id", "rss_mb", "driver", "pagina"}
+        self.transfers = []  # {"record_id", "bytes"}
+        self.recycles = []  # {"record_id", "driver", "motivo", "paginas", "rss_mb"}
+
+    def record(self, stage, seconds, record_id=None):
+        with self._lock:
+            self.timings.append({"record_id": record_id, "etapa": stage, "segundos": seconds})
+
+    @contextmanager
+    def timed(self, stage, record_id=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, record_id)
+
+    def record_memory(self, record_id, rss_mb, driver=None, page=None):
+        """Muestra de memoria tras un ID; `driver` y `page` arman la curva de cada driver"""
+        with self._lock:
+            self.memory.append({"record_id": record_id, "rss_mb": rss_mb, "driver": driver, "pagina": page})
+
+    def record_recycle(self, record_id, driver, reason, pages, rss_mb):
+        with self._lock:
+            self.recycles.append(
+                {"record_id": record_id, "driver": driver, "motivo": reason, "paginas": pages, "rss_mb": rss_mb}
+            )
+
+    def record_transfer(self, record_id, num_bytes):
+        with self._lock:
+            self.transfers.append({"record_id": record_id, "bytes": num_bytes})
+
+    def kb_per_page(self):
+        """Promedio de KB transferidos por página de captura (None si no se midió)"""
+        with self._lock:
+            if not self.transfers:
+                return None
+            return sum(t["bytes"] for t in self.transfers) / len(self.transfers) / 1024
+
+    def timings_frame(self):
+        with self._lock:
+            return pd.DataFrame(self.timings, columns=["record_id", "etapa", "segundos"])
+
+    def memory_frame(self):
+        with self._lock:
+            return pd.DataFrame(self.memory, columns=["record_id", "rss_mb", "driver", "pagina"])
+
+    def recycles_frame(self):
+        with self._lock:
+            return pd.DataFrame(self.recycles, columns=["record_id", "driver", "motivo", "paginas", "rss_mb"])
+
+    def summary(self):
+        """Conteo, p50, p95, máximo y total por etapa"""
+        df = self.timings_frame()
+        if df.empty:
+            return df
+        grouped = df.groupby("etapa", sort=False)["segundos"]
+        return pd.DataFrame({
+            "n": grouped.count(),
+            "p50": grouped.quantile(0.5),
+            "p95": grouped.quantile(0.95),
+            "max": grouped.max(),
+            "total": grouped.sum(),
+        }).round(3)
+
+    def per_record_totals(self):
+        """Segundos totales por Record ID (sin las etapas generales)"""
+        df = self.timings_frame().dropna(subset=["record_id"])
+        return df.groupby("record_id")["segundos"].sum()
+
+    def to_csv(self):
+        timings = self.timings_frame()
+        memory = self.memory_frame()[["record_id", "rss_mb"]]
+        if not memory.empty:
+            memory = memory.assign(etapa="rss_driver_mb", segundos=None)
+            timings = pd.concat([timings, memory], ignore_index=True)
+        with self._lock:
+            transfers = pd.DataFrame(self.transfers, columns=["record_id", "bytes"])
+        if not transfers.empty:
+            transfers = transfers.assign(etapa="bytes_pagina", segundos=None)
+            timings = pd.concat([timings, transfers], ignore_index=True)
+        return timings.to_csv(index=False).encode("utf-8")
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps(
+                {"tiempos": self.timings, "memoria": self.memory, "transferencia": self.transfers,
+                 "reciclajes": self.recycles},
+                default=str,
+            ).encode("utf-8")
+
+def process_tree_rss_mb(pid):
+    """Memoria residente (MB) de un proceso y todos sus descendientes, leída de /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # El nombre del comando va entre paréntesis y puede tener espacios
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+def is_pid_alive(pid):
+    """¿Sigue corriendo el proceso `pid`? Un zombie (hijo terminado sin esperar) no cuenta"""
     try:
-        st.info("Iniciando Chrome para descarga de códigos de barras...")
-        
-        chrome_options = get_chrome_options()
-        
-        # Crear directorio temporal para descargas
-        folder = "codigos_barras"
-        os.makedirs(folder, exist_ok=True)
-        
-        # Intentar inicializar el driver
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return False
+
+def available_memory_mb():
+    """Memoria disponible (MB): la menor entre MemAvailable y lo que queda del límite del cgroup"""
+    available = float("inf")
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+
+    # cgroup v2 y v1: el contenedor puede tener menos memoria que la máquina
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
         try:
-            driver = webdriver.Chrome(options=chrome_options)
-            st.success("✅ Driver de Chrome inicializado exitosamente")
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < 1 << 60:
+            available = min(available, (int(limit) - usage) / (1024 * 1024))
+        break
+    return available
+
+def driver_rss_mb(driver):
+    """Memoria del chromedriver y del Chrome que controla (None si no se puede medir)"""
+    try:
+        return process_tree_rss_mb(driver.service.process.pid)
+    except Exception:
+        return None
+
+# =========================================
+# Destino de las Imágenes (Disco o Memoria)
+# =========================================
+# Una imagen es la ruta de un PNG en disco o, en el pipeline en memoria, una
+# tupla (nombre_archivo, bytes_png). Los ZIP en memoria usan la misma forma.
+def save_image_to_disk(id_val, png_bytes, folder="codigos_barras"):
+    """Escribir el PNG en `folder/<id>.png` y retornar su ruta"""
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{id_val}.png")
+    with open(path, "wb") as f:
+        f.write(png_bytes)
+    return path
+
+def save_image_in_memory(id_val, png_bytes):
+    """Mantener el PNG en memoria, sin tocar el disco"""
+    return (f"{id_val}.png", png_bytes)
+
+def image_name(image):
+    """Nombre de archivo de una imagen en disco o en memoria"""
+    return image[0] if isinstance(image, tuple) else os.path.basename(image)
+
+def image_size(image):
+    """Tamaño en bytes de una imagen (o ZIP) en disco o en memoria"""
+    return len(image[1]) if isinstance(image, tuple) else os.path.getsize(image)
+
+def image_data(image):
+    """Bytes PNG de una imagen en disco o en memoria"""
+    if isinstance(image, tuple):
+        return image[1]
+    with open(image, "rb") as f:
+        return f.read()
+
+# =========================================
+# Funciones Auxiliares del Driver
+# =========================================
+def login_redcap(driver, username, password, wait):
+    """Iniciar sesión en RedCap con el driver dado (lanza excepción si falla)"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.support import expected_conditions as EC
+
+    driver.get(LOGIN_URL)
+
+    username_field = wait.until(EC.presence_of_element_located((By.ID, "username")))
+    username_field.clear()
+    username_field.send_keys(username)
+
+    password_field = wait.until(EC.presence_of_element_located((By.ID, "password")))
+    password_field.clear()
+    password_field.send_keys(password)
+    password_field.send_keys(Keys.ENTER)
+
+    # La página de login ya tiene la misma URL: esperar a que el formulario se vaya
+    wait.until(EC.staleness_of(password_field))
+    wait.until(EC.url_contains("record_status_dashboard.php"))
+
+def inject_session_cookies(driver, cookies):
+    """Reutilizar la sesión de RedCap de otro driver copiando sus cookies"""
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # Las cookies solo se pueden agregar estando en el dominio de RedCap
+    # (con la carga "none", driver.get retorna antes de llegar a él)
+    driver.get(LOGIN_URL)
+    WebDriverWait(driver, 30).until(lambda d: d.current_url.startswith(REDCAP_BASE_URL))
+    for cookie in cookies:
+        driver.add_cookie(cookie)
+
+class SessionExpiredError(Exception):
+    """RedCap cerró la sesión y redirigió el driver a la página de inicio de sesión"""
+
+def is_login_page(driver):
+    """Detectar si el driver está viendo el formulario de inicio de sesión de RedCap"""
+    from selenium.webdriver.common.by import By
+
+    return bool(driver.find_elements(By.ID, "password"))
+
+# =========================================
+# Control de Admisión de Chrome (todo el contenedor)
+# =========================================
+# Un archivo por cupo de Chrome; lo comparten Streamlit y los workers de jobs.py
+CHROME_SLOTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cupos_chrome")
+# Segundos durante los que una solicitud sin cupo pide a otros procesos cerrar sus drivers libres
+CHROME_DEMAND_WINDOW = 60
+
+class BrowserAdmission:
+    """Límite global de instancias de Chrome y cola FIFO de capturas.
+
+    Cada Chrome vivo tiene tomado un cupo: un flock sobre uno de los
+    `max_instances` archivos de `slots_dir`, que además guarda el PID del
+    dueño. Así el límite vale para todos los procesos del contenedor (las
+    sesiones de Streamlit y los trabajos en segundo plano), y el sistema
+    operativo libera los cupos de un proceso que muere. Solo se lanza un
+    Chrome más si hay cupo y la memoria disponible, tras reservar
+    `instance_mb`, sigue por encima de `reserve_mb`.
+
+    La cola FIFO, la posición y la ETA son de este proceso: las capturas de
+    las sesiones de Streamlit esperan su turno con un ticket y el primero de
+    la cola es el único que puede tomar drivers. Los trabajos en segundo plano
+    no entran en esa cola; compiten directamente por los archivos de cupo.
+    """
+
+    def __init__(self, max_instances, instance_mb=400, reserve_mb=512, slots_dir=CHROME_SLOTS_DIR):
+        self.max_instances = max_instances
+        self.instance_mb = instance_mb
+        self.reserve_mb = reserve_mb
+        self.slots_dir = slots_dir
+        os.makedirs(slots_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._held = []  # Archivos de cupo tomados por este proceso (uno por Chrome vivo)
+        self._pools = []
+        self._queue = deque()  # Tickets esperando, en orden de llegada
+        self._running = {}  # ticket -> inicio de la captura
+        self._avg_run_seconds = None
+        self._tickets = itertools.count(1)
+
+    def register_pool(self, pool):
+        with self._lock:
+            self._pools.append(pool)
+
+    def _slot_paths(self):
+        return [os.path.join(self.slots_dir, f"cupo_{number}.lock") for number in range(self.max_instances)]
+
+    def live_instances(self):
+        """Chrome vivos en todo el contenedor: cupos con el PID de un proceso vivo.
+
+        Solo lee los archivos; tomar el flock de un cupo libre para probarlo
+        haría fallar el _claim_slot de otro proceso en ese instante.
+        """
+        live = 0
+        for path in self._slot_paths():
+            try:
+                with open(path) as f:
+                    pid = int(f.read().strip() or 0)
+            except (OSError, ValueError):
+                continue
+            if pid and is_pid_alive(pid):
+                live += 1
+        return live
+
+    def _claim_slot(self):
+        # Con ningún Chrome vivo se admite uno igual: esperar no liberaría memoria
+        live = self.live_instances()
+        if live >= self.max_instances:
+            return False
+        if live and available_memory_mb() - self.instance_mb < self.reserve_mb:
+            return False
+        for path in self._slot_paths():
+            f = open(path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            # Dueño del cupo para live_instances; un proceso que murió deja un PID inexistente
+            f.truncate(0)
+            f.write(str(os.getpid()))
+            f.flush()
+            self._held.append(f)
+            return True
+        return False
+
+    def reserve(self):
+        """Reservar lugar para lanzar un Chrome; False si no hay cupo.
+
+        Si falta cupo se cierra un driver libre de algún pool del proceso, y se
+        avisa a los demás procesos para que cierren los suyos.
+        """
+        with self._lock:
+            if self._claim_slot():
+                return True
+            pools = list(self._pools)
+        for pool in pools:
+            if pool.close_idle_driver():
+                break
+        with self._lock:
+            if self._claim_slot():
+                return True
+        self._signal_demand()
+        return False
+
+    def release(self):
+        """Un Chrome se cerró: liberar uno de los cupos del proceso"""
+        with self._lock:
+            if self._held:
+                f = self._held.pop()
+                f.truncate(0)
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+
+    def _signal_demand(self):
+        with open(os.path.join(self.slots_dir, "demanda"), "w") as f:
+            f.write(str(os.getpid()))
+
+    def demand_from_others(self):
+        """¿Otro proceso se quedó sin cupo hace menos de CHROME_DEMAND_WINDOW segundos?"""
+        path = os.path.join(self.slots_dir, "demanda")
+        try:
+            if time.time() - os.path.getmtime(path) > CHROME_DEMAND_WINDOW:
+                return False
+            with open(path) as f:
+                return f.read().strip() != str(os.getpid())
+        except (OSError, ValueError):
+            return False
+
+    def enqueue(self):
+        """Entrar a la cola; retorna el ticket de la captura"""
+        with self._lock:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            return ticket
+
+    def is_next(self, ticket):
+        with self._lock:
+            return bool(self._queue) and self._queue[0] == ticket
+
+    def start(self, ticket):
+        """La captura obtuvo su primer driver: sale de la cola y pasa a ejecución"""
+        with self._lock:
+            self._queue.remove(ticket)
+            self._running[ticket] = time.monotonic()
+
+    def leave(self, ticket):
+        """La captura terminó (o se abandonó mientras esperaba)"""
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+            started = self._running.pop(ticket, None)
+            if started is not None:
+                duration = time.monotonic() - started
+                if self._avg_run_seconds is None:
+                    self._avg_run_seconds = duration
+                else:
+                    self._avg_run_seconds = 0.7 * self._avg_run_seconds + 0.3 * duration
+
+    def waiting(self):
+        with self._lock:
+            return len(self._queue)
+
+    def position(self, ticket):
+        """Posición en la cola (1 = siguiente), o 0 si ya no está esperando"""
+        with self._lock:
+            return self._queue.index(ticket) + 1 if ticket in self._queue else 0
+
+    def eta(self, ticket):
+        """Segundos estimados hasta el turno del ticket (None sin historial)"""
+        with self._lock:
+            if self._avg_run_seconds is None or ticket not in self._queue:
+                return None
+            ahead = self._queue.index(ticket)
+            now = time.monotonic()
+            remaining = sorted(
+                max(0.0, self._avg_run_seconds - (now - started)) for started in self._running.values()
+            ) or [0.0]
+            rounds, slot = divmod(ahead, len(remaining))
+            return remaining[slot] + rounds * self._avg_run_seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chrome_vivos": self.live_instances(),
+                "maximo": self.max_instances,
+                "en_cola": len(self._queue),
+                "en_ejecucion": len(self._running),
+                "memoria_libre_mb": available_memory_mb(),
+            }
+
+@st.cache_resource
+def get_browser_admission():
+    """Control de admisión compartido por las sesiones de Streamlit del proceso (el cupo, con todo el contenedor)"""
+    return BrowserAdmission(
+        max_instances=int(st.secrets.get("max_chrome_instances", os.cpu_count() or 1)),
+        instance_mb=float(st.secrets.get("chrome_instance_mb", 400)),
+        reserve_mb=float(st.secrets.get("chrome_memory_reserve_mb", 512)),
+    )
+
+# =========================================
+# Pool Persistente de Drivers Autenticados
+# =========================================
+class DriverPool:
+    """Pool de drivers de Chrome con sesión iniciada en RedCap.
+
+    Los drivers sobreviven entre reruns y sesiones de Streamlit: se revisa su
+    salud al entregarlos, se vuelve a iniciar sesión cuando RedCap la expira y
+    se cierran tras `idle_timeout` segundos sin uso (o antes, si otro proceso
+    espera cupo). Con `admission`, cada Chrome nuevo necesita además cupo en
+    el límite global del contenedor.
+    """
+
+    def __init__(self, username, password, max_size, idle_timeout=600, lean=False, admission=None, pipelined=False):
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.lean = lean
+        self.pipelined = pipelined
+        self.admission = admission
+        self.idle_timeout = idle_timeout
+        self._idle = []  # [(driver, último uso)]
+        self._size = 0
+        self._served = {}  # id(driver) -> [número de driver, páginas visitadas]
+        self._numbers = itertools.count(1)
+        self._cookies = None
+        self._cond = threading.Condition()
+
+        if admission:
+            admission.register_pool(self)
+
+        reaper = threading.Thread(target=self._reap_idle, daemon=True)
+        reaper.start()
+
+    def login(self, driver, metrics=None):
+        """Iniciar sesión con el driver y guardar sus cookies para los nuevos drivers"""
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        metrics = metrics or CaptureMetrics()
+        with metrics.timed("login"):
+            login_redcap(driver, self.username, self.password, WebDriverWait(driver, 30))
+        with self._cond:
+            self._cookies = driver.get_cookies()
+
+    def _create(self, metrics=None):
+        from selenium import webdriver
+
+        metrics = metrics or CaptureMetrics()
+        with metrics.timed("iniciar_chrome"):
+            driver = webdriver.Chrome(options=get_chrome_options(lean=self.lean, pipelined=self.pipelined))
+        try:
+            if self.lean:
+                apply_lean_profile(driver)
+            if self._cookies:
+                with metrics.timed("copiar_cookies"):
+                    inject_session_cookies(driver, self._cookies)
+            else:
+                self.login(driver, metrics)
+        except Exception:
+            driver.quit()
+            raise
+        return driver
+
+    def count_page(self, driver):
+        """Sumar una página al driver; retorna (número de driver, páginas visitadas)"""
+        with self._cond:
+            if id(driver) not in self._served:
+                self._served[id(driver)] = [next(self._numbers), 0]
+            served = self._served[id(driver)]
+            served[1] += 1
+            return tuple(served)
+
+    def is_healthy(self, driver):
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def acquire(self, block=True, timeout=None, metrics=None):
+        """Entregar un driver sano con sesión iniciada.
+
+        Si no hay drivers libres y el pool está lleno, espera hasta `timeout`
+        segundos (o retorna None con `block=False`).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            driver = None
+            with self._cond:
+                if self._idle:
+                    driver, _ = self._idle.pop()  # El más reciente sigue caliente
+                elif self._size < self.max_size:
+                    self._size += 1
+                elif not block:
+                    return None
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No hay drivers de Chrome disponibles en el pool")
+                    self._cond.wait(remaining)
+                    continue
+
+            if driver is None:
+                # Fuera del lock: reserve() puede cerrar drivers libres de otros pools
+                if self.admission and not self.admission.reserve():
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    if not block:
+                        return None
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError("Límite global de instancias de Chrome alcanzado")
+                    time.sleep(0.5)
+                    continue
+                try:
+                    return self._create(metrics)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    if self.admission:
+                        self.admission.release()
+                    raise
+
+            if self.is_healthy(driver):
+                return driver
+            self.discard(driver)
+
+    def release(self, driver):
+        """Devolver un driver al pool para reutilizarlo"""
+        with self._cond:
+            self._idle.append((driver, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, driver):
+        """Cerrar un driver dañado y liberar su lugar en el pool"""
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._served.pop(id(driver), None)
+            self._cond.notify()
+        if self.admission:
+            self.admission.release()
+
+    def replace(self, driver, metrics=None):
+        """Cambiar un driver dañado por uno nuevo con sesión iniciada"""
+        self.discard(driver)
+        return self.acquire(metrics=metrics)
+
+    def evict_idle(self):
+        """Cerrar los drivers que llevan más de `idle_timeout` segundos sin uso"""
+        now = time.monotonic()
+        with self._cond:
+            stale = [d for d, last_used in self._idle if now - last_used > self.idle_timeout]
+            self._idle = [(d, t) for d, t in self._idle if now - t <= self.idle_timeout]
+        for driver in stale:
+            self.discard(driver)
+
+    def close_idle_driver(self):
+        """Cerrar el driver libre más antiguo para ceder su cupo; False si no hay"""
+        with self._cond:
+            if not self._idle:
+                return False
+            driver, _ = self._idle.pop(0)
+        self.discard(driver)
+        return True
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(30)
+            self.evict_idle()
+            # Otro proceso (p. ej. un trabajo en segundo plano) espera cupo: ceder los drivers libres
+            if self.admission and self.admission.demand_from_others():
+                while self.close_idle_driver():
+                    pass
+
+    def close(self):
+        """Cerrar todos los drivers libres (al apagar el proceso)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for driver, _ in idle:
+            self.discard(driver)
+
+    def stats(self):
+        with self._cond:
+            return {"total": self._size, "libres": len(self._idle)}
+
+@st.cache_resource
+def get_driver_pool(username, password, lean=False, pipelined=False):
+    """Pool de drivers compartido por todas las sesiones de Streamlit del proceso.
+
+    Hay uno por perfil y otro aparte para el modo en pipeline (carga "none").
+    """
+    pool = DriverPool(username, password, max_size=os.cpu_count() or 1, lean=lean,
+                      admission=get_browser_admission(), pipelined=pipelined)
+    atexit.register(pool.close)
+    return pool
+
+# =========================================
+# Políticas de Reintento por Etapa
+# =========================================
+# Intentos y espera exponencial con jitter (segundos) por etapa de la captura.
+# Se pueden ajustar desde secrets, p. ej. [retry_policies.navegar] attempts = 5
+RETRY_POLICIES = {
+    "navegar": {"attempts": 3, "multiplier": 1.0, "max_wait": 10.0},
+    "listo": {"attempts": 2, "multiplier": 2.0, "max_wait": 15.0},
+    "captura": {"attempts": 3, "multiplier": 0.5, "max_wait": 5.0},
+    "api": {"attempts": 4, "multiplier": 1.0, "max_wait": 30.0},
+}
+for _stage, _overrides in dict(st.secrets.get("retry_policies", {})).items():
+    RETRY_POLICIES.setdefault(_stage, {}).update(dict(_overrides))
+
+# Pasadas extra al final del lote para los IDs que fallaron
+DEFERRED_RETRY_PASSES = 1
+# Fallos seguidos de un worker antes de reiniciar su driver
+MAX_CONSECUTIVE_FAILURES = 3
+# Vigilante de memoria: reciclar el driver tras N páginas o sobre este RSS (0 desactiva)
+DRIVER_RECYCLE_PAGES = int(st.secrets.get("driver_recycle_pages", 500))
+DRIVER_RECYCLE_RSS_MB = float(st.secrets.get("driver_recycle_rss_mb", 1500))
+
+# Mensajes de chromedriver cuando Chrome o la sesión ya no existen
+SESSION_LOST_MESSAGES = ("invalid session id", "chrome not reachable", "disconnected", "session deleted")
+
+def is_session_lost(error):
+    """¿El error indica que Chrome o su sesión murieron? Reintentar con el mismo driver no sirve"""
+    from selenium.common.exceptions import (
+        InvalidSessionIdException,
+        NoSuchWindowException,
+        SessionNotCreatedException,
+    )
+
+    if isinstance(error, (InvalidSessionIdException, NoSuchWindowException, SessionNotCreatedException)):
+        return True
+    return any(message in str(error).lower() for message in SESSION_LOST_MESSAGES)
+
+def retrying(stage, retry_on=None):
+    """Crear un `tenacity.Retrying` con la política de la etapa dada.
+
+    Por defecto reintenta TimeoutException y WebDriverException de Selenium,
+    salvo las de un Chrome o una sesión perdidos (ver is_session_lost): esas
+    suben de inmediato para que el worker reemplace el driver.
+    """
+    if retry_on is None:
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+        retry = retry_if_exception(
+            lambda error: isinstance(error, (TimeoutException, WebDriverException)) and not is_session_lost(error)
+        )
+    else:
+        retry = retry_if_exception_type(retry_on)
+    policy = RETRY_POLICIES[stage]
+    return Retrying(
+        stop=stop_after_attempt(policy["attempts"]),
+        wait=wait_random_exponential(multiplier=policy["multiplier"], max=policy["max_wait"]),
+        retry=retry,
+        before_sleep=lambda state: logger.warning(
+            "Reintentando etapa %s (intento %d): %s", stage, state.attempt_number, state.outcome.exception()
+        ),
+        reraise=True,
+    )
+
+# =========================================
+# Detección de Página Lista (sin esperas fijas)
+# =========================================
+# Script asíncrono: resuelve apenas tr#barcode-tr está visible, sin indicador
+# "PIPING DATA" y con sus imágenes decodificadas. Retorna "ready", "no-row" o
+# "loading" (estado al agotarse el tiempo).
+BARCODE_READY_JS = """
+const timeoutMs = arguments[0];
+const done = arguments[arguments.length - 1];
+let finished = false;
+
+function isVisible(el) {
+    const rect = el.getBoundingClientRect();
+    const style = window.getComputedStyle(el);
+    return rect.width > 0 && rect.height > 0 && style.visibility !== 'hidden' && style.display !== 'none';
+}
+
+function pipingVisible() {
+    const snapshot = document.evaluate("//*[contains(text(),'PIPING DATA')]", document, null,
+                                       XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    for (let i = 0; i < snapshot.snapshotLength; i++) {
+        if (isVisible(snapshot.snapshotItem(i))) return true;
+    }
+    return false;
+}
+
+function probe() {
+    const row = document.querySelector('tr#barcode-tr');
+    if (!row) return ['no-row', null];
+    if (!isVisible(row) || pipingVisible()) return ['loading', null];
+    for (const img of row.querySelectorAll('img')) {
+        if (!img.complete || img.naturalWidth === 0) return ['loading', null];
+    }
+    for (const canvas of row.querySelectorAll('canvas')) {
+        if (canvas.width === 0 || canvas.height === 0) return ['loading', null];
+    }
+    return ['ready', row];
+}
+
+function finish(state) {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearInterval(poller);
+    clearTimeout(timer);
+    done(state);
+}
+
+function check() {
+    if (finished) return;
+    const [state, row] = probe();
+    if (state !== 'ready') return;
+    finished = true;
+    observer.disconnect();
+    clearInterval(poller);
+    clearTimeout(timer);
+    row.scrollIntoView({block: 'center'});
+    const decodes = Array.from(row.querySelectorAll('img')).map(img => img.decode().catch(() => null));
+    // Esperar dos frames para que el scroll y las imágenes estén pintados
+    Promise.all(decodes).then(() => nextFrame(() => nextFrame(() => done('ready'))));
+}
+
+// requestAnimationFrame no corre en pestañas en segundo plano (modo pipeline): un temporizador lo reemplaza
+function nextFrame(callback) {
+    let called = false;
+    const once = () => { if (!called) { called = true; callback(); } };
+    requestAnimationFrame(once);
+    setTimeout(once, 50);
+}
+
+const observer = new MutationObserver(check);
+observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+document.addEventListener('load', check, true);  // Carga de imágenes (no burbujea)
+const poller = setInterval(check, 100);  // Cambios de estilo que no generan mutaciones
+const timer = setTimeout(() => finish(probe()[0]), timeoutMs);
+check();
+"""
+
+class AdaptiveTimeout:
+    """Tiempo de espera que se ajusta a la latencia observada (estilo RTO de TCP).
+
+    timeout = promedio + 4 * desviación, acotado entre `minimum` y `maximum`.
+    Hasta tener algunas muestras usa `maximum`.
+    """
+
+    def __init__(self, minimum=5.0, maximum=30.0, min_samples=3):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self.samples = 0
+        self.mean = None
+        self.deviation = 0.0
+
+    def observe(self, seconds):
+        self.samples += 1
+        if self.mean is None:
+            self.mean = seconds
+            self.deviation = seconds / 2
+        else:
+            self.deviation = 0.75 * self.deviation + 0.25 * abs(seconds - self.mean)
+            self.mean = 0.875 * self.mean + 0.125 * seconds
+
+    @property
+    def value(self):
+        if self.samples < self.min_samples:
+            return self.maximum
+        return max(self.minimum, min(self.maximum, self.mean + 4 * self.deviation))
+
+def wait_for_barcode_ready(driver, timeout):
+    """Esperar (sin sleeps fijos) a que el código de barras esté listo para capturar.
+
+    Retorna "ready", "no-row" o "loading"; los dos últimos indican que se agotó
+    el tiempo.
+    """
+    driver.set_script_timeout(timeout + 5)
+    return driver.execute_async_script(BARCODE_READY_JS, int(timeout * 1000))
+
+def crop_barcode_png(png_bytes, compact=False):
+    """Recortar en memoria los 2/3 izquierdos de la captura de la fila y re-codificar como PNG.
+
+    Con `compact`, la misma imagen decodificada se recorta además al código de
+    barras y se codifica a 1 bit: una sola decodificación y una sola
+    codificación por captura.
+    """
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(png_bytes))
+    w, h = img.size
+    new_w = int(w * 2 / 3)
+    img_cropped = img.crop((0, 0, new_w, h))
+    if compact:
+        from barcode_images import trim_barcode_image
+        img_cropped = trim_barcode_image(img_cropped)
+    output = io.BytesIO()
+    img_cropped.save(output, format="PNG", optimize=compact)
+    return output.getvalue()
+
+def capture_barcode(driver, id_val, readiness_timeout, metrics=None, compact=False):
+    """Capturar y recortar el código de barras de un Record ID.
+
+    Retorna los bytes PNG recortados (compactos con `compact`), o None si la
+    página no tiene código de barras.
+    """
+    timings = {}
+    page = {}
+    try:
+        return _capture_barcode_stages(driver, id_val, readiness_timeout, timings, page, compact)
+    finally:
+        if metrics:
+            for stage, seconds in timings.items():
+                metrics.record(stage, seconds, id_val)
+            if "bytes" in page:
+                metrics.record_transfer(id_val, page["bytes"])
+
+def _capture_barcode_stages(driver, id_val, readiness_timeout, timings, page, compact=False):
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+
+    stage_start = time.perf_counter()
+
+    target_url = TARGET_URL_TEMPLATE.format(id_val=id_val)
+    for attempt in retrying("navegar"):
+        with attempt:
+            driver.get(target_url)
+
+    if is_login_page(driver):
+        raise SessionExpiredError(f"Sesión de RedCap expirada al abrir ID {id_val}")
+    timings["navegar"] = time.perf_counter() - stage_start
+
+    # Esperar a que el código de barras esté visible y decodificado
+    stage_start = time.perf_counter()
+    for attempt in retrying("listo"):
+        with attempt:
+            state = wait_for_barcode_ready(driver, readiness_timeout.value)
+            if state == "loading":
+                raise TimeoutException(f"Código de barras no listo tras {readiness_timeout.value:.1f}s")
+    timings["listo"] = time.perf_counter() - stage_start
+    if state == "no-row":
+        logger.info("ID %s sin tr#barcode-tr tras %.2fs", id_val, timings["listo"])
+        return None
+    readiness_timeout.observe(timings["listo"])
+    page["bytes"] = driver.execute_script(PAGE_TRANSFER_JS)
+
+    # Tomar captura de pantalla
+    stage_start = time.perf_counter()
+    for attempt in retrying("captura"):
+        with attempt:
+            tr_el = driver.find_element(By.CSS_SELECTOR, "tr#barcode-tr")
+            screenshot_png = tr_el.screenshot_as_png
+    timings["captura"] = time.perf_counter() - stage_start
+
+    # Procesar y recortar imagen (sin pasar por disco)
+    stage_start = time.perf_counter()
+    cropped_png = crop_barcode_png(screenshot_png, compact)
+    timings["recorte"] = time.perf_counter() - stage_start
+
+    logger.info(
+        "ID %s: %s (timeout listo=%.1fs)",
+        id_val,
+        " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in timings.items()),
+        readiness_timeout.value,
+    )
+    return cropped_png
+
+def _replace_driver(pool, driver, metrics):
+    """pool.replace sin excepciones: retorna el driver nuevo, o None si Chrome no se pudo relanzar.
+
+    Con None el driver original ya está descartado y el worker debe terminar.
+    """
+    try:
+        return pool.replace(driver, metrics)
+    except Exception as e:
+        logger.error("No se pudo reemplazar el driver de Chrome: %s", e)
+        return None
+
+def _check_driver_memory(pool, driver, id_val, metrics):
+    """Vigilante de memoria: medir el driver tras una página y reciclarlo si hace falta.
+
+    Retorna el driver para el siguiente ID (None si el reemplazo falló). El
+    reemplazo reutiliza las cookies de sesión del pool; si RedCap ya las
+    expiró, el worker vuelve a iniciar sesión.
+    """
+    number, pages = pool.count_page(driver)
+    rss_mb = driver_rss_mb(driver)
+    metrics.record_memory(id_val, rss_mb, number, pages)
+
+    if DRIVER_RECYCLE_PAGES and pages >= DRIVER_RECYCLE_PAGES:
+        reason = "páginas"
+    elif DRIVER_RECYCLE_RSS_MB and rss_mb is not None and rss_mb >= DRIVER_RECYCLE_RSS_MB:
+        reason = "memoria"
+    else:
+        return driver
+
+    logger.info("Reciclando driver %d por %s (%d páginas, %s MB)", number, reason, pages, rss_mb)
+    metrics.record_recycle(id_val, number, reason, pages, rss_mb)
+    return _replace_driver(pool, driver, metrics)
+
+def _capture_worker(pool, driver, work_queue, events, save, metrics, compact=False):
+    """Consumir (idx, id) de la cola compartida y reportar cada resultado en `events`.
+
+    Se ejecuta en un hilo propio; no llama a funciones de Streamlit. Retorna el
+    driver con el que terminó, que puede ser un reemplazo del original, o None
+    si Chrome no se pudo relanzar (los IDs sin reportar quedan para
+    _run_capture_pass).
+    """
+    from selenium.common.exceptions import TimeoutException
+
+    readiness_timeout = AdaptiveTimeout()
+    consecutive_failures = 0
+    while True:
+        try:
+            idx, id_val = work_queue.get_nowait()
+        except queue.Empty:
+            return driver
+
+        if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            # Fallos repetidos suelen indicar un Chrome degradado: empezar con uno nuevo
+            logger.warning("%d fallos seguidos, reiniciando driver", consecutive_failures)
+            driver = _replace_driver(pool, driver, metrics)
+            if driver is None:
+                work_queue.put((idx, id_val))
+                return None
+            readiness_timeout = AdaptiveTimeout()
+            consecutive_failures = 0
+
+        try:
+            try:
+                png = capture_barcode(driver, id_val, readiness_timeout, metrics, compact)
+            except SessionExpiredError:
+                pool.login(driver, metrics)
+                png = capture_barcode(driver, id_val, readiness_timeout, metrics, compact)
+            if png:
+                with metrics.timed("guardar", id_val):
+                    image = save(id_val, png)
+                events.put((idx, id_val, image, None))
+            else:
+                events.put((idx, id_val, None, ("warning", f"⚠️ Elemento de código de barras no encontrado para ID: {id_val}")))
+            consecutive_failures = 0
+        except TimeoutException:
+            consecutive_failures += 1
+            events.put((idx, id_val, None, ("error", f"⏰ Tiempo de espera agotado para Record ID: {id_val}")))
         except Exception as e:
-            st.error(f"❌ Fallo al inicializar el driver de Chrome: {e}")
-            st.info("💡 Esto podría deberse a la falta del navegador Chrome en el entorno de la nube.")
-            return []
-        
-        wait = WebDriverWait(driver, 30)  # Tiempo de espera aumentado
+            consecutive_failures += 1
+            events.put((idx, id_val, None, ("error", f"❌ Error al procesar ID {id_val}: {e}")))
+            # Si Chrome se cayó, continuar con un driver nuevo
+            if not pool.is_healthy(driver):
+                driver = _replace_driver(pool, driver, metrics)
+                if driver is None:
+                    return None
+                continue
 
-        # Iniciar sesión en RedCap
-        st.info("🔐 Iniciando sesión en RedCap...")
-        url = "https://redcap.prisma.org.pe/redcap_v14.5.11/DataEntry/record_status_dashboard.php?pid=19"
-        
+        driver = _check_driver_memory(pool, driver, id_val, metrics)
+        if driver is None:
+            return None
+
+# =========================================
+# Navegación en Pipeline (varias pestañas por driver)
+# =========================================
+def _open_tabs(driver, count, lean=False):
+    """Asegurar `count` pestañas abiertas en el driver y retornar sus handles.
+
+    Los comandos CDP del perfil liviano solo valen para la pestaña donde se
+    ejecutan, así que con `lean` se aplican en cada pestaña nueva.
+    """
+    while len(driver.window_handles) < count:
+        driver.switch_to.new_window("tab")
+        if lean:
+            apply_lean_profile(driver)
+    return list(driver.window_handles)[:count]
+
+def _close_extra_tabs(driver, handles):
+    """Dejar el driver con una sola pestaña antes de devolverlo al pool"""
+    try:
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+    except Exception:
+        pass
+
+def _start_navigation(driver, handle, id_val):
+    """Empezar a cargar el ID en la pestaña sin esperar a que termine la carga"""
+    driver.switch_to.window(handle)
+    driver.execute_script("window.location.href = arguments[0];", TARGET_URL_TEMPLATE.format(id_val=id_val))
+
+def _await_tab_barcode(driver, id_val, readiness_timeout, timings, page):
+    """Esperar en la pestaña actual el código de barras de `id_val` y tomar su captura.
+
+    Retorna el PNG de la fila sin recortar, o None si la página no tiene código
+    de barras. Anota en `page["bytes"]` lo transferido por la página.
+    """
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # Hasta que llega la respuesta, la pestaña sigue mostrando la página del ID anterior
+    stage_start = time.perf_counter()
+    WebDriverWait(driver, 30).until(lambda d: f"&id={id_val}&" in d.current_url or is_login_page(d))
+    if is_login_page(driver):
+        raise SessionExpiredError(f"Sesión de RedCap expirada al abrir ID {id_val}")
+    timings["navegar"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    for attempt in retrying("listo"):
+        with attempt:
+            state = wait_for_barcode_ready(driver, readiness_timeout.value)
+            if state == "loading":
+                raise TimeoutException(f"Código de barras no listo tras {readiness_timeout.value:.1f}s")
+    timings["listo"] = time.perf_counter() - stage_start
+    if state == "no-row":
+        return None
+    readiness_timeout.observe(timings["listo"])
+    page["bytes"] = driver.execute_script(PAGE_TRANSFER_JS)
+
+    stage_start = time.perf_counter()
+    for attempt in retrying("captura"):
+        with attempt:
+            screenshot_png = driver.find_element(By.CSS_SELECTOR, "tr#barcode-tr").screenshot_as_png
+    timings["captura"] = time.perf_counter() - stage_start
+    return screenshot_png
+
+def _pipelined_capture_worker(pool, driver, work_queue, events, save, metrics, tabs, compact=False):
+    """Como _capture_worker, pero con `tabs` pestañas en un solo driver.
+
+    Mientras se captura la pestaña que lleva más tiempo cargando, las demás ya
+    cargan los IDs siguientes; el recorte y el guardado corren en otro hilo.
+    Si el driver se recicla o se cae (también al navegar o abrir pestañas),
+    los IDs en curso vuelven a la cola. Retorna el driver final, o None si
+    Chrome no se pudo relanzar.
+    """
+    from selenium.common.exceptions import TimeoutException
+
+    readiness_timeout = AdaptiveTimeout()
+    image_worker = ThreadPoolExecutor(max_workers=1)
+    # (handle, idx, id_val, sesión con la que empezó a cargar, ya reintentado)
+    in_flight = deque()
+    session = 0  # Sube con cada nuevo inicio de sesión
+    handles = []  # Vacío: hay que abrir las pestañas del driver actual
+    failures = 0  # Caídas seguidas del driver fuera de la captura de un ID
+
+    def navigate(handle, idx, id_val, retried=False):
+        # Se anota antes de navegar: si el driver falla, el ID vuelve a la cola con los demás
+        in_flight.append((handle, idx, id_val, session, retried))
+        _start_navigation(driver, handle, id_val)
+
+    def fill(handle):
+        try:
+            idx, id_val = work_queue.get_nowait()
+        except queue.Empty:
+            return
+        navigate(handle, idx, id_val)
+
+    def requeue_in_flight():
+        while in_flight:
+            _, idx, id_val, _, _ = in_flight.popleft()
+            work_queue.put((idx, id_val))
+
+    def recover(error):
+        # Los IDs en curso vuelven a la cola y se reparten en las pestañas de un driver nuevo.
+        # Retorna False si hay que dejar este worker (demasiadas caídas o Chrome no se relanzó).
+        nonlocal driver, handles, failures
+        failures += 1
+        logger.warning("Driver con pestañas falló (%d seguidas): %s", failures, error)
+        requeue_in_flight()
+        if failures > MAX_CONSECUTIVE_FAILURES:
+            return False
+        driver = _replace_driver(pool, driver, metrics)
+        handles = []
+        return driver is not None
+
+    def process_image(idx, id_val, screenshot_png):
+        # Hilo de imágenes: no toca el driver
+        try:
+            with metrics.timed("recorte", id_val):
+                png = crop_barcode_png(screenshot_png, compact)
+            with metrics.timed("guardar", id_val):
+                image = save(id_val, png)
+            events.put((idx, id_val, image, None))
+        except Exception as e:
+            events.put((idx, id_val, None, ("error", f"❌ Error al procesar ID {id_val}: {e}")))
+
+    try:
+        while driver is not None:
+            try:
+                if not handles:
+                    handles = _open_tabs(driver, tabs, lean=pool.lean)
+                    for handle in handles:
+                        fill(handle)
+                if not in_flight:
+                    break
+                handle, idx, id_val, started_session, retried = in_flight.popleft()
+            except Exception as e:
+                # Navegar o abrir pestañas falló: el driver no sirve
+                if not recover(e):
+                    break
+                continue
+
+            timings = {}
+            page = {}
+            try:
+                driver.switch_to.window(handle)
+                screenshot_png = _await_tab_barcode(driver, id_val, readiness_timeout, timings, page)
+            except SessionExpiredError:
+                if retried:
+                    events.put((idx, id_val, None, ("error", f"❌ Sesión de RedCap rechazada para ID {id_val}")))
+                    handles_ok = True
+                else:
+                    # Si otra pestaña ya renovó la sesión después de que esta empezó a cargar, basta con recargar
+                    try:
+                        if started_session == session:
+                            pool.login(driver, metrics)
+                            session += 1
+                        navigate(handle, idx, id_val, retried=True)
+                        continue
+                    except Exception as e:
+                        events.put((idx, id_val, None, ("error", f"❌ No se pudo reiniciar la sesión de RedCap: {e}")))
+                        handles_ok = pool.is_healthy(driver)
+                screenshot_png = None
+            except TimeoutException:
+                events.put((idx, id_val, None, ("error", f"⏰ Tiempo de espera agotado para Record ID: {id_val}")))
+                screenshot_png = None
+                handles_ok = True
+            except Exception as e:
+                events.put((idx, id_val, None, ("error", f"❌ Error al procesar ID {id_val}: {e}")))
+                screenshot_png = None
+                handles_ok = pool.is_healthy(driver)
+            else:
+                if screenshot_png is None:
+                    events.put((idx, id_val, None, ("warning", f"⚠️ Elemento de código de barras no encontrado para ID: {id_val}")))
+                handles_ok = True
+                failures = 0
+            finally:
+                for stage, seconds in timings.items():
+                    metrics.record(stage, seconds, id_val)
+                if "bytes" in page:
+                    metrics.record_transfer(id_val, page["bytes"])
+
+            if screenshot_png:
+                image_worker.submit(process_image, idx, id_val, screenshot_png)
+            if not handles_ok:
+                # Chrome se cayó: continuar con un driver nuevo
+                if not recover(f"Chrome no responde tras el ID {id_val}"):
+                    break
+                continue
+
+            try:
+                # La pestaña queda libre: empezar ya a cargar el siguiente ID
+                fill(handle)
+                new_driver = _check_driver_memory(pool, driver, id_val, metrics)
+            except Exception as e:
+                if not recover(e):
+                    break
+                continue
+            if new_driver is not driver:
+                requeue_in_flight()
+                driver, handles = new_driver, []
+    finally:
+        image_worker.shutdown(wait=True)
+        if driver is not None and handles and pool.is_healthy(driver):
+            _close_extra_tabs(driver, handles)
+    return driver
+
+# Segundos entre revisiones de si los workers siguen vivos mientras se esperan eventos
+EVENT_POLL_INTERVAL = 1.0
+
+def _run_capture_pass(pool, drivers, items, save, on_event, metrics, tabs=1, compact=False):
+    """Repartir `items` [(idx, id)] entre los drivers y esperar a que terminen.
+
+    Con `tabs` > 1 cada driver trabaja en pipeline con esa cantidad de
+    pestañas; `compact` se pasa al recorte de cada captura.
+    `on_event(idx, id_val, image, error, done)` se llama en el hilo principal
+    por cada ID. `drivers` se actualiza en el lugar con los drivers
+    finales, que pueden ser reemplazos; los que se cayeron sin reemplazo ya no
+    están. Si todos los workers terminan, los IDs que ninguno reportó se
+    reportan como error.
+    """
+    work_queue = queue.Queue()
+    for item in items:
+        work_queue.put(item)
+    events = queue.Queue()
+    worker = _pipelined_capture_worker if tabs > 1 else _capture_worker
+    extra = (tabs,) if tabs > 1 else ()
+
+    reported = set()
+    done = 0
+    with ThreadPoolExecutor(max_workers=len(drivers)) as executor:
+        futures = [
+            executor.submit(worker, pool, d, work_queue, events, save, metrics, *extra, compact=compact)
+            for d in drivers
+        ]
         try:
-            driver.get(url)
+            while len(reported) < len(items):
+                try:
+                    idx, id_val, image, error = events.get(timeout=EVENT_POLL_INTERVAL)
+                except queue.Empty:
+                    # Un worker termina después de poner sus eventos: si todos terminaron, no llegan más
+                    if all(future.done() for future in futures) and events.empty():
+                        break
+                    continue
+                reported.add(idx)
+                done += 1
+                on_event(idx, id_val, image, error, done)
+
+            for idx, id_val in items:
+                if idx not in reported:
+                    done += 1
+                    on_event(idx, id_val, None, ("error", f"❌ Sin driver de Chrome disponible para ID {id_val}"), done)
+        finally:
+            # Solo los drivers vivos vuelven al llamador (y de ahí al pool)
+            live = []
+            for future in futures:
+                try:
+                    driver = future.result()
+                except Exception as e:
+                    logger.error("Worker de captura terminó con error: %s", e)
+                    driver = None
+                if driver is not None:
+                    live.append(driver)
+            drivers[:] = live
+    return drivers
+
+# =========================================
+# Progreso y Errores sin Saturar la Interfaz
+# =========================================
+# Segundos mínimos entre actualizaciones de la barra de progreso y del estado
+UI_UPDATE_INTERVAL = 0.5
+ERROR_LABELS = {"error": "error", "warning": "sin código de barras"}
+
+class ThrottledProgress:
+    """Barra de progreso y mensaje de estado que se redibujan como máximo cada `interval` segundos"""
+
+    def __init__(self, interval=UI_UPDATE_INTERVAL):
+        self.interval = interval
+        self._bar = st.progress(0)
+        self._status = st.empty()
+        self._last = 0.0
+
+    def update(self, fraction, message=None, force=False):
+        now = time.monotonic()
+        if not force and fraction < 1 and now - self._last < self.interval:
+            return
+        self._last = now
+        self._bar.progress(min(1.0, fraction))
+        if message:
+            self._status.info(message)
+
+def show_error_summary(errors):
+    """Un solo aviso con la tabla de IDs sin imagen, en lugar de un elemento por ID.
+
+    `errors` es una lista de (record_id, nivel, mensaje) con nivel "error" o "warning".
+    """
+    if not errors:
+        return
+    df = pd.DataFrame(
+        [(id_val, ERROR_LABELS.get(level, level), message) for id_val, level, message in errors],
+        columns=["Record ID", "Tipo", "Detalle"],
+    )
+    counts = df["Tipo"].value_counts()
+    st.warning(
+        f"⚠️ {len(df)} Record IDs sin imagen: " + ", ".join(f"{n} {label}" for label, n in counts.items())
+    )
+    st.dataframe(df, use_container_width=True, hide_index=True)
+
+# =========================================
+# Función de Captura de Pantalla de Códigos de Barras de RedCap
+# =========================================
+# Máximo que una captura espera su turno en la cola de Chrome
+ADMISSION_TIMEOUT = 1800
+
+def wait_for_admission(admission, ticket, pool, metrics, timeout=ADMISSION_TIMEOUT):
+    """Esperar el turno en la cola FIFO y retornar el primer driver de la captura.
+
+    Mientras espera muestra la posición en la cola y el tiempo estimado.
+    """
+    queue_message = st.empty()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            if admission.is_next(ticket):
+                driver = pool.acquire(block=False, metrics=metrics)
+                if driver is not None:
+                    admission.start(ticket)
+                    return driver
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Sin cupo de Chrome tras {timeout // 60} minutos en la cola")
+
+            eta = admission.eta(ticket)
+            stats = admission.stats()
+            # La cola es de este proceso; los trabajos en segundo plano solo ocupan instancias
+            queue_message.info(
+                f"🕒 En cola para abrir Chrome: posición {admission.position(ticket)} de {stats['en_cola']} "
+                f"({stats['chrome_vivos']}/{stats['maximo']} instancias en uso, incluidos los trabajos en segundo plano) — "
+                + (f"turno estimado en ~{eta:.0f}s" if eta is not None else "calculando tiempo estimado...")
+            )
+            time.sleep(1)
+    finally:
+        queue_message.empty()
+
+def download_barcode_images(record_ids, username, password, num_workers=1, save=None, metrics=None, lean=False,
+                            tabs=1, compact=False):
+    """Descargar imágenes de códigos de barras para Record IDs específicos desde RedCap.
+
+    Los drivers salen del pool persistente (ya con sesión iniciada), tras
+    esperar turno en la cola de Chrome del proceso. Con `num_workers` > 1 los IDs
+    se reparten entre varias sesiones de Chrome, y con `tabs` > 1 cada sesión
+    carga varios IDs a la vez en pestañas. Con `compact` cada recorte sale ya
+    compacto (ver crop_barcode_png). Cada
+    PNG pasa por `save(id_val, png_bytes)` (por defecto save_image_to_disk) y el
+    resultado conserva el orden de `record_ids`.
+    """
+    save = save or save_image_to_disk
+    metrics = metrics or CaptureMetrics()
+    pool = get_driver_pool(username, password, lean=lean, pipelined=tabs > 1)
+    admission = get_browser_admission()
+    ticket = admission.enqueue()
+    drivers = []
+    try:
+        total_ids = len(record_ids)
+        num_workers = max(1, min(num_workers, total_ids))
+
+        # Obtener drivers del pool (se inicia Chrome y sesión solo si no hay libres)
+        try:
+            drivers.append(wait_for_admission(admission, ticket, pool, metrics))
         except Exception as e:
-            st.error(f"❌ Fallo al cargar la URL de RedCap: {e}")
+            st.error(f"❌ Fallo al obtener un driver de Chrome con sesión en RedCap: {e}")
+            st.info("💡 Esto podría deberse a la falta del navegador Chrome en el entorno de la nube.")
             return []
 
-        # Proceso de inicio de sesión
+        for _ in range(num_workers - 1):
+            if admission.waiting():
+                # Sesiones extra solo si nadie más espera: cada captura avanza con al menos un Chrome
+                st.warning(f"⚠️ Otras capturas esperan turno, usando {len(drivers)} sesiones en paralelo")
+                break
+            try:
+                extra_driver = pool.acquire(block=False, metrics=metrics)
+            except Exception as e:
+                st.warning(f"⚠️ No se pudo abrir una sesión adicional de Chrome: {e}")
+                break
+            if extra_driver is None:
+                st.warning(f"⚠️ Pool de Chrome lleno, usando {len(drivers)} sesiones en paralelo")
+                break
+            drivers.append(extra_driver)
+
+        results = [None] * total_ids
+        errors = {}  # idx -> (nivel, mensaje) del último intento
+        captured = 0
+        progress = ThrottledProgress()
+
+        items = list(enumerate(record_ids))
+        for retry_pass in range(1 + DEFERRED_RETRY_PASSES):
+            if retry_pass > 0:
+                # Reintento diferido: solo errores, no IDs sin código de barras
+                items = [(idx, record_ids[idx]) for idx, (level, _) in errors.items() if level == "error"]
+                if not items or not drivers:
+                    break
+                progress.update(0, f"🔁 Reintentando {len(items)} IDs fallidos (pasada {retry_pass})...", force=True)
+
+            def on_event(idx, id_val, image, error, done):
+                nonlocal captured
+                if image:
+                    captured += results[idx] is None
+                    results[idx] = image
+                    errors.pop(idx, None)
+                else:
+                    errors[idx] = error
+
+                # Combinar el progreso de todos los workers en una sola barra
+                progress.update(
+                    done / len(items),
+                    f"📥 {done}/{len(items)} IDs procesados ({captured} imágenes, {len(errors)} con problemas)",
+                )
+
+            # Los workers pueden haber reemplazado drivers caídos (o perdido alguno)
+            _run_capture_pass(pool, drivers, items, save, on_event, metrics, tabs=tabs, compact=compact)
+
+        show_error_summary([(record_ids[idx], *errors[idx]) for idx in sorted(errors)])
+
+        downloaded_files = [path for path in results if path]
+        return downloaded_files
+
+    except Exception as e:
+        st.error(f"❌ Error en la descarga de códigos de barras: {e}")
+        return []
+    
+    finally:
+        for driver in drivers:
+            pool.release(driver)
+        admission.leave(ticket)
+
+# =========================================
+# Motor sin Navegador: API de RedCap + Renderizado Local
+# =========================================
+# Patrones de Code 128 (anchos de barra/espacio) para los valores 0-106
+CODE128_PATTERNS = [
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232", "2331112",
+]
+CODE128_START_B = 104
+CODE128_STOP = 106
+
+# Tamaño (ancho, alto) de las imágenes del motor API, para que coincidan con los recortes
+# de download_barcode_images (2/3 de la fila tr#barcode-tr). Ese tamaño depende del
+# formulario y de la ventana de Chrome, así que se configura con el secreto
+# barcode_image_size medido sobre una captura real, p. ej.:
+#   python -c "from PIL import Image; print(Image.open('codigos_barras/5.png').size)"
+# (1100, 130) es solo una estimación para una ventana de 1920 px.
+BARCODE_IMAGE_SIZE = tuple(st.secrets.get("barcode_image_size", (1100, 130)))
+
+def encode_code128(value):
+    """Codificar un texto en Code 128 (set B) como lista de anchos de módulos"""
+    codes = [CODE128_START_B]
+    for char in str(value):
+        code = ord(char) - 32
+        if not 0 <= code <= 94:
+            raise ValueError(f"Carácter no soportado en Code 128: {char!r}")
+        codes.append(code)
+    checksum = (codes[0] + sum(i * code for i, code in enumerate(codes[1:], start=1))) % 103
+    codes += [checksum, CODE128_STOP]
+    return [int(width) for code in codes for width in CODE128_PATTERNS[code]]
+
+def render_barcode_png(value, module_width=2, bar_height=80, compact=False):
+    """Dibujar el código de barras de `value` con su texto y retornarlo como bytes PNG.
+
+    Con `compact` se recorta y codifica a 1 bit antes de codificar, como crop_barcode_png.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    widths = encode_code128(value)
+    img = Image.new("RGB", BARCODE_IMAGE_SIZE, "white")
+    draw = ImageDraw.Draw(img)
+
+    barcode_width = sum(widths) * module_width
+    x = (BARCODE_IMAGE_SIZE[0] - barcode_width) // 2
+    y = 15
+    for i, width in enumerate(widths):
+        # Los elementos alternan barra (pares) y espacio (impares)
+        if i % 2 == 0:
+            draw.rectangle([x, y, x + width * module_width - 1, y + bar_height - 1], fill="black")
+        x += width * module_width
+
+    font = ImageFont.load_default()
+    text = str(value)
+    text_width = draw.textlength(text, font=font)
+    draw.text(((BARCODE_IMAGE_SIZE[0] - text_width) / 2, y + bar_height + 8), text, fill="black", font=font)
+
+    if compact:
+        from barcode_images import trim_barcode_image
+        img = trim_barcode_image(img)
+    output = io.BytesIO()
+    img.save(output, format="PNG", optimize=compact)
+    return output.getvalue()
+
+def fetch_barcode_values(record_ids, api_token, batch_size=500):
+    """Exportar en bloque el valor del código de barras de cada Record ID desde la API de RedCap.
+
+    Hace una sola solicitud POST por lote de `batch_size` IDs y retorna un dict
+    {record_id: valor}.
+    """
+    values = {}
+    for start in range(0, len(record_ids), batch_size):
+        batch = record_ids[start:start + batch_size]
+        payload = {
+            "token": api_token,
+            "content": "record",
+            "format": "json",
+            "type": "flat",
+            "returnFormat": "json",
+            "fields[0]": "record_id",
+        }
+        if REDCAP_BARCODE_FIELD != "record_id":
+            payload["fields[1]"] = REDCAP_BARCODE_FIELD
+        if REDCAP_API_EVENT:
+            payload["events[0]"] = REDCAP_API_EVENT
+        for i, id_val in enumerate(batch):
+            payload[f"records[{i}]"] = str(id_val)
+
+        for attempt in retrying("api", retry_on=requests.RequestException):
+            with attempt:
+                response = requests.post(REDCAP_API_URL, data=payload, timeout=60)
+                response.raise_for_status()
+        for row in response.json():
+            value = row.get(REDCAP_BARCODE_FIELD)
+            if value:
+                # Con varios eventos, quedarse con el primer valor no vacío
+                values.setdefault(str(row["record_id"]), value)
+    return values
+
+def redcap_timestamp(timestamp):
+    """Marca de tiempo POSIX como texto en la hora local del servidor de RedCap (para dateRangeBegin)"""
+    return datetime.fromtimestamp(timestamp - REDCAP_CLOCK_MARGIN, REDCAP_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+
+def fetch_modified_record_ids(record_ids, api_token, since, batch_size=500):
+    """Retornar los Record IDs (como str) creados o modificados en RedCap desde `since` (marca POSIX)"""
+    modified = set()
+    for start in range(0, len(record_ids), batch_size):
+        batch = record_ids[start:start + batch_size]
+        payload = {
+            "token": api_token,
+            "content": "record",
+            "format": "json",
+            "type": "flat",
+            "returnFormat": "json",
+            "fields[0]": "record_id",
+            "dateRangeBegin": redcap_timestamp(since),
+        }
+        for i, id_val in enumerate(batch):
+            payload[f"records[{i}]"] = str(id_val)
+
+        for attempt in retrying("api", retry_on=requests.RequestException):
+            with attempt:
+                response = requests.post(REDCAP_API_URL, data=payload, timeout=60)
+                response.raise_for_status()
+        modified.update(str(row["record_id"]) for row in response.json())
+    return modified
+
+def download_barcode_images_api(record_ids, api_token, save=None, metrics=None, compact=False):
+    """Generar imágenes de códigos de barras sin navegador (API de RedCap + PIL).
+
+    Entrega cada PNG a `save(id_val, png_bytes)` igual que download_barcode_images.
+    """
+    save = save or save_image_to_disk
+    metrics = metrics or CaptureMetrics()
+    try:
+        st.info("🔌 Consultando la API de RedCap...")
         try:
-            username_field = wait.until(EC.presence_of_element_located((By.ID, "username")))
-            username_field.clear()
-            username_field.send_keys(username)
-            
-            password_field = wait.until(EC.presence_of_element_located((By.ID, "password")))
-            password_field.clear()
-            password_field.send_keys(password)
-            password_field.send_keys(Keys.ENTER)
-            
-            wait.until(EC.url_contains("record_status_dashboard.php"))
-            st.success("✅ ¡Inicio de sesión exitoso en RedCap!")
+            with metrics.timed("api_exportar"):
+                values = fetch_barcode_values(record_ids, api_token)
         except Exception as e:
-            st.error(f"❌ Fallo en el inicio de sesión: {e}")
+            st.error(f"❌ Fallo al consultar la API de RedCap: {e}")
             return []
 
-        TARGET_URL_TEMPLATE = (
-            "https://redcap.prisma.org.pe/redcap_v14.5.11/DataEntry/index.php?pid=19&id={id_val}&event_id=59&page=recepcion_de_muestra"
-        )
-
         downloaded_files = []
-        progress_bar = st.progress(0)
-        
+        errors = []
+        progress = ThrottledProgress()
         total_ids = len(record_ids)
 
-        status_message = st.empty()
-        
         for idx, id_val in enumerate(record_ids):
-            try:
-                status_message.info(f"📸 Procesando Record ID: {id_val} ({idx + 1}/{total_ids})")
-                
-                target_url = TARGET_URL_TEMPLATE.format(id_val=id_val)
-                driver.get(target_url)
-                
-                # Esperar a que la página se cargue
-                WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CSS_SELECTOR, "table tbody")))
-
-                # Esperar a que desaparezcan los indicadores de carga
+            value = values.get(str(id_val))
+            if not value:
+                errors.append((id_val, "warning", f"⚠️ Código de barras no encontrado en la API para ID: {id_val}"))
+            else:
                 try:
-                    loading_locator = (By.XPATH, "//*[contains(text(),'PIPING DATA')]")
-                    WebDriverWait(driver, 5).until(EC.invisibility_of_element_located(loading_locator))
-                except TimeoutException:
-                    pass  # No se encontró indicador de carga o desapareció
+                    with metrics.timed("renderizar", id_val):
+                        png = render_barcode_png(value, compact=compact)
+                    with metrics.timed("guardar", id_val):
+                        downloaded_files.append(save(id_val, png))
+                except Exception as e:
+                    errors.append((id_val, "error", f"❌ Error al generar imagen para ID {id_val}: {e}"))
+            progress.update((idx + 1) / total_ids, f"🖨️ {idx + 1}/{total_ids} códigos de barras generados")
 
-                # Encontrar el elemento del código de barras
-                try:
-                    tr_selector = "tr#barcode-tr"
-                    tr_el = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, tr_selector)))
-                except TimeoutException:
-                    st.warning(f"⚠️ Elemento de código de barras no encontrado para ID: {id_val}")
+        show_error_summary(errors)
+        return downloaded_files
+
+    except Exception as e:
+        st.error(f"❌ Error en la generación de códigos de barras: {e}")
+        return []
+
+# =========================================
+# Caché de Imágenes en Disco
+# =========================================
+class BarcodeCache:
+    """Caché persistente de PNGs recortados por proyecto, evento y Record ID.
+
+    Vive fuera de `codigos_barras`, así que sobrevive a la limpieza de cada
+    ejecución. Al superar `max_bytes` se eliminan primero las imágenes usadas
+    hace más tiempo (LRU). La fecha de modificación de cada archivo es la fecha
+    de captura y la de acceso, su último uso.
+
+    El disco es la única fuente de verdad: Streamlit y los trabajos en segundo
+    plano comparten la carpeta, así que no hay índice en memoria. La limpieza
+    se serializa entre procesos con un flock sobre `.lock` y recorre la carpeta
+    como máximo una vez cada CACHE_EVICT_INTERVAL segundos por proceso; entre
+    recorridos el límite puede superarse brevemente.
+
+    Las imágenes compactas (`compact`) van en su propia carpeta: cada caché
+    entrega siempre el mismo formato que produciría una captura nueva.
+    """
+
+    def __init__(self, root, project_id, event_id, max_bytes, compact=False):
+        variant = "_1bit" if compact else ""
+        self.folder = os.path.join(root, f"pid{project_id}_event{event_id}{variant}")
+        self.max_bytes = max_bytes
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock_path = os.path.join(self.folder, ".lock")
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.png")
+
+    def _scan(self):
+        """[(último uso, clave, tamaño)] de las imágenes en disco, de la menos a la más recientemente usada"""
+        files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".png"):
                     continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Eliminada por otro proceso durante el recorrido
+                files.append((stat.st_atime, entry.name[:-len(".png")], stat.st_size))
+        return sorted(files)
 
-                # Hacer scroll al elemento y esperar
-                driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", tr_el)
-                time.sleep(1.4)
+    def get(self, id_val):
+        """Retornar los bytes PNG en caché, o None si no están"""
+        path = self._path(str(id_val))
+        try:
+            with open(path, "rb") as f:
+                png_bytes = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            pass  # Otro proceso la eliminó después de leerla
+        return png_bytes
+
+    def put(self, id_val, png_bytes):
+        """Guardar una imagen recién capturada y aplicar el límite de tamaño"""
+        path = self._path(str(id_val))
+        # Escribir aparte y renombrar: otro proceso nunca lee un PNG a medio escribir
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png_bytes)
+        os.replace(tmp_path, path)
 
-                # Tomar captura de pantalla
-                screenshot_path = os.path.join(folder, f"{id_val}.png")
-                tr_el.screenshot(screenshot_path)
+        with self._lock:
+            if time.monotonic() - self._last_evict < CACHE_EVICT_INTERVAL:
+                return
+            self._last_evict = time.monotonic()
+        self._evict()
 
-                # Procesar y recortar imagen
+    def _evict(self):
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            files = self._scan()
+            total = sum(size for _, _, size in files)
+            # Conservar siempre la más reciente, aunque sola supere el límite
+            for _, key, size in files[:-1]:
+                if total <= self.max_bytes:
+                    break
                 try:
-                    img = Image.open(screenshot_path)
-                    w, h = img.size
-                    new_w = int(w * 2 / 3)
-                    img_cropped = img.crop((0, 0, new_w, h))
-                    img_cropped.save(screenshot_path)
-                    downloaded_files.append(screenshot_path)
-                    status_message.success(f"✅ Código de barras descargado para ID: {id_val}")
-                except Exception as e:
-                    st.error(f"❌ Error al procesar imagen para ID {id_val}: {e}")
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+                total -= size
 
-            except TimeoutException:
-                st.error(f"⏰ Tiempo de espera agotado para Record ID: {id_val}")
-            except Exception as e:
-                st.error(f"❌ Error al procesar ID {id_val}: {e}")
-            
-            # Actualizar barra de progreso
-            progress_bar.progress((idx + 1) / total_ids)
+    def invalidate(self, id_val):
+        try:
+            os.remove(self._path(str(id_val)))
+        except FileNotFoundError:
+            pass
 
-        return downloaded_files
+    def captured_at(self, id_val):
+        """Fecha de captura (timestamp) de la imagen en caché, o None"""
+        try:
+            return os.stat(self._path(str(id_val))).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def invalidate_modified(self, record_ids, api_token):
+        """Invalidar las imágenes de records modificados en RedCap después de capturarlas.
+
+        Retorna la cantidad de imágenes invalidadas.
+        """
+        captured = {}
+        for id_val in record_ids:
+            timestamp = self.captured_at(id_val)
+            if timestamp is not None:
+                captured[str(id_val)] = timestamp
+        if not captured:
+            return 0
+
+        # Una sola consulta desde la captura más antigua; puede invalidar de más, nunca de menos
+        modified = fetch_modified_record_ids(list(captured), api_token, min(captured.values()))
+        for key in modified:
+            self.invalidate(key)
+        return len(modified)
+
+    def stats(self):
+        files = self._scan()
+        return {"imagenes": len(files), "mb": sum(size for _, _, size in files) / (1024 * 1024)}
+
+@st.cache_resource
+def get_barcode_cache(compact=False):
+    """Caché de imágenes (normales o compactas) compartida por todas las sesiones de Streamlit del proceso"""
+    max_mb = float(st.secrets.get("barcode_cache_max_mb", 500))
+    return BarcodeCache(BARCODE_CACHE_DIR, REDCAP_PROJECT_ID, REDCAP_EVENT_ID, int(max_mb * 1024 * 1024), compact)
+
+def download_with_cache(record_ids, capture, use_cache=True, api_token=None, save=None, compact=False):
+    """Reutilizar imágenes en caché y enviar solo los IDs faltantes a `capture`.
+
+    `capture(ids, save)` es uno de los motores de captura y `compact` indica si
+    produce imágenes compactas (elige la caché). Si se pasa `api_token`, antes
+    se invalidan los records modificados en RedCap. El resultado conserva el
+    orden de `record_ids`.
+    """
+    save = save or save_image_to_disk
+
+    if not use_cache:
+        return capture(record_ids, save)
+
+    cache = get_barcode_cache(compact)
+    if api_token:
+        try:
+            invalidated = cache.invalidate_modified(record_ids, api_token)
+            if invalidated:
+                st.info(f"♻️ {invalidated} imágenes en caché invalidadas por modificaciones en RedCap")
+        except Exception as e:
+            st.warning(f"⚠️ No se pudo verificar la fecha de modificación en RedCap: {e}")
+
+    files_by_id = {}
+    pending_ids = []
+    for id_val in record_ids:
+        png_bytes = cache.get(id_val)
+        if png_bytes:
+            files_by_id[str(id_val)] = save(id_val, png_bytes)
+        else:
+            pending_ids.append(id_val)
+
+    st.info(f"🗃️ Caché: {len(files_by_id)} aciertos, {len(pending_ids)} fallos")
+
+    def save_and_cache(id_val, png_bytes):
+        # Se llama desde los hilos de captura; BarcodeCache.put es seguro entre hilos y procesos
+        cache.put(id_val, png_bytes)
+        image = save(id_val, png_bytes)
+        files_by_id[str(id_val)] = image
+        return image
+
+    if pending_ids:
+        capture(pending_ids, save_and_cache)
+
+    return [files_by_id[str(id_val)] for id_val in record_ids if str(id_val) in files_by_id]
+
+# =========================================
+# Ejecución de una Captura
+# =========================================
+ENGINE_SELENIUM = "Navegador (Selenium)"
+ENGINE_API = "API de RedCap (sin navegador)"
+
+def compact_images(images, save, metrics=None):
+    """Recortar y compactar en lote (pool de procesos) imágenes ya capturadas.
+
+    Cada resultado se vuelve a pasar por `save`, que sobrescribe el archivo en
+    disco o actualiza el checkpoint del trabajo.
+    """
+    from barcode_images import compact_png_batch
+
+    if not images:
+        return images
+    record_ids = [os.path.splitext(image_name(image))[0] for image in images]
+    before = sum(len(image_data(image)) for image in images)
+    start = time.perf_counter()
+    compacted = compact_png_batch([image_data(image) for image in images])
+    if metrics:
+        metrics.record("compactar_lote", time.perf_counter() - start)
+    after = sum(len(png_bytes) for png_bytes in compacted)
+    st.info(f"🗜️ Imágenes compactadas: {before / 1024:.0f} KB → {after / 1024:.0f} KB")
+    return [save(id_val, png_bytes) for id_val, png_bytes in zip(record_ids, compacted)]
+
+def run_capture(record_ids, options, save, metrics=None):
+    """Capturar `record_ids` con las opciones elegidas en la interfaz.
+
+    `options` tiene las claves engine, num_workers, use_cache, validate_cache y
+    lean, y opcionalmente tabs (pestañas por driver), compact y compact_batch
+    (recorte automático por ID o en lote al final). La usan tanto la interfaz como el worker en segundo
+    plano de jobs.py.
+    """
+    compact_batch = options.get("compact", False) and options.get("compact_batch", False)
+    # Sin lote, cada captura sale ya compacta del mismo paso que la recorta
+    compact = options.get("compact", False) and not compact_batch
+
+    if options["engine"] == ENGINE_API:
+        if not redcap_api_token:
+            st.error("❌ Falta el secreto 'redcap_api_token' para usar la API de RedCap.")
+            return []
+        if not REDCAP_BARCODE_FIELD:
+            st.error("❌ Falta el secreto 'redcap_barcode_field' (campo con el valor del código de barras).")
+            return []
+        capture = lambda ids, save: download_barcode_images_api(
+            ids, redcap_api_token, save=save, metrics=metrics, compact=compact
+        )
+    else:
+        capture = lambda ids, save: download_barcode_images(
+            ids, redcap_username, redcap_password, num_workers=int(options["num_workers"]), save=save,
+            metrics=metrics, lean=options.get("lean", False), tabs=int(options.get("tabs", 1)), compact=compact
+        )
+
+    images = download_with_cache(
+        record_ids,
+        capture,
+        use_cache=options["use_cache"],
+        api_token=redcap_api_token if options["validate_cache"] else None,
+        save=save,
+        compact=compact,
+    )
+    if compact_batch:
+        images = compact_images(images, save, metrics)
+    return images
+
+# =========================================
+# Modo Delta (solo records nuevos o modificados)
+# =========================================
+DELTA_NEW = "nuevo"
+DELTA_CHANGED = "modificado"
+DELTA_UNCHANGED = "sin cambios"
+# Destinatario anotado en el manifiesto cuando la entrega fue una descarga directa
+DELIVERY_DOWNLOAD = "descarga directa"
 
+@st.cache_resource
+def get_delivery_manifest():
+    """Manifiesto de capturas y entregas del proyecto y evento configurados"""
+    return DeliveryManifest(REDCAP_PROJECT_ID, REDCAP_EVENT_ID, st.secrets.get("manifest_db_path", MANIFEST_DB_PATH))
+
+def classify_delta(record_ids, manifest, api_token=None):
+    """{record_id (str): estado} con DELTA_NEW, DELTA_CHANGED o DELTA_UNCHANGED.
+
+    Los IDs nunca entregados son nuevos. Los entregados se agrupan por fecha
+    de entrega y la API de RedCap dice cuáles cambiaron desde entonces; sin
+    `api_token` todos los entregados quedan sin cambios.
+    """
+    entries = manifest.entries(record_ids)
+    statuses = {}
+    delivered = {}
+    for id_val in record_ids:
+        entry = entries.get(str(id_val))
+        if entry is None or entry["delivered_at"] is None:
+            statuses[str(id_val)] = DELTA_NEW
+        else:
+            statuses[str(id_val)] = DELTA_UNCHANGED
+            delivered.setdefault(entry["delivered_at"], []).append(id_val)
+
+    if api_token:
+        for delivered_at, ids in delivered.items():
+            for key in fetch_modified_record_ids(ids, api_token, delivered_at):
+                statuses[key] = DELTA_CHANGED
+    return statuses
+
+def select_delta_ids(record_ids):
+    """Retornar (estados, IDs a capturar) mostrando el resumen del modo delta.
+
+    Si RedCap no responde se capturan todos los IDs y los estados son None.
+    """
+    if not redcap_api_token:
+        st.warning("⚠️ Sin 'redcap_api_token' el modo delta solo detecta records nuevos, no modificados.")
+    try:
+        statuses = classify_delta(record_ids, get_delivery_manifest(), redcap_api_token)
     except Exception as e:
-        st.error(f"❌ Error en la descarga de códigos de barras: {e}")
-        return []
-    
-    finally:
-        if driver:
-            try:
-                driver.quit()
-                st.info("🔄 Driver de Chrome cerrado")
-            except:
-                pass
+        st.warning(f"⚠️ No se pudo consultar la fecha de modificación en RedCap; se capturan todos los IDs: {e}")
+        return None, record_ids
+
+    counts = {state: 0 for state in (DELTA_NEW, DELTA_CHANGED, DELTA_UNCHANGED)}
+    for state in statuses.values():
+        counts[state] += 1
+    st.info(
+        f"🔺 Modo delta: {counts[DELTA_NEW]} nuevos, {counts[DELTA_CHANGED]} modificados, "
+        f"{counts[DELTA_UNCHANGED]} sin cambios desde su última entrega"
+    )
+
+    # La imagen en caché de un record modificado ya no sirve, en ningún formato
+    caches = (get_barcode_cache(), get_barcode_cache(compact=True))
+    for key, state in statuses.items():
+        if state == DELTA_CHANGED:
+            for cache in caches:
+                cache.invalidate(key)
+    return statuses, [id_val for id_val in record_ids if statuses[str(id_val)] != DELTA_UNCHANGED]
+
+def manifest_csv(manifest, included_ids, statuses=None):
+    """Manifiesto completo como CSV en memoria: (nombre, bytes)"""
+    def format_time(timestamp):
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if pd.notna(timestamp) else ""
+
+    columns = ["record_id", "captured_at", "delivered_at", "email_receiver", "image_sha1"]
+    df = pd.DataFrame(manifest.rows(), columns=["project_id", "event_id", *columns])[columns]
+    included = {str(id_val) for id_val in included_ids}
+    df.insert(1, "en_este_envio", df["record_id"].isin(included))
+    if statuses:
+        df.insert(2, "estado_delta", df["record_id"].map(statuses).fillna(""))
+    for column in ("captured_at", "delivered_at"):
+        df[column] = df[column].map(format_time)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"manifiesto_pid{manifest.project_id}_evento{manifest.event_id}_{timestamp}.csv"
+    return (filename, df.to_csv(index=False).encode("utf-8"))
+
+def register_capture(images, include_manifest=False, statuses=None):
+    """Anotar las imágenes capturadas en el manifiesto y retornar los adjuntos del envío.
+
+    Con `include_manifest` se agrega al final el CSV del manifiesto completo.
+    """
+    manifest = get_delivery_manifest()
+    captured = {os.path.splitext(image_name(image))[0]: image_data(image) for image in images}
+    manifest.mark_captured(captured)
+    attachments = list(images)
+    if include_manifest:
+        attachments.append(manifest_csv(manifest, captured, statuses))
+    return attachments
+
+def register_delivery(images, email_receiver, started_at):
+    """Marcar las imágenes como entregadas; `started_at` es el inicio de la corrida"""
+    record_ids = [os.path.splitext(image_name(image))[0] for image in images]
+    get_delivery_manifest().mark_delivered(record_ids, email_receiver, started_at)
+
+def register_zip_download(zip_bytes, started_at):
+    """on_click de los botones de descarga: las imágenes de ese ZIP quedan entregadas"""
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipf:
+        images = [member for member in zipf.namelist() if member.endswith(".png")]
+    register_delivery(images, DELIVERY_DOWNLOAD, started_at)
 
 # =========================================
 # Función de Creación de ZIP - FUNCIÓN FALTANTE
 # =========================================
-def create_zip_file(attachment_files, record_ids):
-    """Crear un archivo ZIP que contenga todas las imágenes de códigos de barras."""
+# Gmail rechaza mensajes de más de 25 MB y el adjunto viaja en base64 (+33%)
+EMAIL_MAX_ZIP_MB = float(st.secrets.get("email_max_zip_mb", 18))
+# Encabezados locales y del directorio central de cada entrada del ZIP
+ZIP_ENTRY_OVERHEAD = 200
+
+def create_zip_file(attachment_files, record_ids, in_memory=False, zip_filename=None):
+    """Crear un archivo ZIP que contenga todas las imágenes de códigos de barras.
+
+    Con `in_memory` el ZIP se arma en memoria y se retorna como (nombre, bytes).
+    """
     try:
         # Crear nombre del archivo ZIP con marca de tiempo
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        zip_filename = f"codigos_barras_redcap_{timestamp}.zip"
-        zip_path = os.path.join("codigos_barras", zip_filename)
+        if not zip_filename:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            zip_filename = f"codigos_barras_redcap_{timestamp}.zip"
         
         st.info(f"📦 Creando archivo ZIP: {zip_filename}")
+
+        if in_memory:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for image in attachment_files:
+                    zipf.writestr(image_name(image), image_data(image))
+            zip_size = buffer.tell() / (1024 * 1024)  # Tamaño en MB
+            st.success(f"✅ Archivo ZIP creado en memoria: {zip_filename} ({zip_size:.2f} MB)")
+            return (zip_filename, buffer.getvalue())
+
+        os.makedirs("codigos_barras", exist_ok=True)
+        zip_path = os.path.join("codigos_barras", zip_filename)
         
         with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for file_path in attachment_files:
-                if os.path.exists(file_path):
+                if isinstance(file_path, tuple):
+                    zipf.writestr(image_name(file_path), image_data(file_path))
+                elif os.path.exists(file_path):
                     # Agregar archivo al ZIP con solo el nombre del archivo (no la ruta completa)
                     filename = os.path.basename(file_path)
                     zipf.write(file_path, filename)
@@ -233,68 +2180,380 @@ def create_zip_file(attachment_files, record_ids):
         st.error(f"❌ Error al crear el archivo ZIP: {e}")
         return None
 
+def create_zip_parts(attachment_files, record_ids, in_memory=False, max_bytes=None):
+    """Repartir las imágenes en uno o más ZIP de como máximo `max_bytes` cada uno.
+
+    Los PNG casi no se comprimen, así que el tamaño de cada parte se estima por
+    adelantado con el tamaño de sus imágenes. Retorna la lista de partes (rutas,
+    o tuplas (nombre, bytes) con `in_memory`); vacía si alguna parte falla.
+    """
+    max_bytes = max_bytes or int(EMAIL_MAX_ZIP_MB * 1024 * 1024)
+
+    groups = []
+    current, current_bytes = [], 0
+    for image in attachment_files:
+        size = image_size(image) + ZIP_ENTRY_OVERHEAD
+        if current and current_bytes + size > max_bytes:
+            groups.append(current)
+            current, current_bytes = [], 0
+        current.append(image)
+        current_bytes += size
+    if current:
+        groups.append(current)
+
+    if len(groups) <= 1:
+        zip_file = create_zip_file(attachment_files, record_ids, in_memory=in_memory)
+        return [zip_file] if zip_file else []
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    parts = []
+    for number, group in enumerate(groups, 1):
+        zip_filename = f"codigos_barras_redcap_{timestamp}_parte{number}de{len(groups)}.zip"
+        zip_file = create_zip_file(group, record_ids, in_memory=in_memory, zip_filename=zip_filename)
+        if not zip_file:
+            return []
+        parts.append(zip_file)
+    return parts
+
 # =========================================
 # Función de Email con Adjunto ZIP - FUNCIÓN FALTANTE
 # =========================================
-def send_email_with_zip(record_ids, attachment_files, email_receiver):
-    """Enviar email con imágenes de códigos de barras como archivo ZIP adjunto."""
+SMTP_HOST = st.secrets.get("smtp_host", "smtp.gmail.com")
+SMTP_PORT = int(st.secrets.get("smtp_port", 465))
+SMTP_SSL = bool(st.secrets.get("smtp_ssl", True))  # False para un servidor SMTP local de pruebas
+
+def open_smtp_connection():
+    """Abrir y autenticar la conexión SMTP (sin AUTH si el servidor no la ofrece)"""
+    if SMTP_SSL:
+        smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context(), timeout=30)
+    else:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    smtp.ehlo()
+    if smtp.has_extn("auth"):
+        smtp.login(email_sender, email_password)
+    return smtp
+
+def build_zip_email(email_receiver, zip_file, total_images, number=1, total_parts=1):
+    """Mensaje con una parte ZIP adjunta"""
+    zip_filename = image_name(zip_file)
+    part_label = f" (parte {number} de {total_parts})" if total_parts > 1 else ""
+
+    em = EmailMessage()
+    em['From'] = email_sender
+    em['To'] = email_receiver
+    em['Subject'] = f"Códigos de Barras RedCap Presiente Lab Muestras Humanas{part_label}"
+
+    html_body = f"""
+    <html>
+      <body>
+        <h2>Códigos de Barras Descargados{part_label}</h2>
+        <p><strong>Total de imágenes procesadas:</strong> {total_images}</p>
+        <p><strong>Archivo adjunto:</strong> {zip_filename} (formato ZIP)</p>
+        {"<p><strong>Las imágenes se enviaron en " + str(total_parts) + " correos por el límite de tamaño de los adjuntos.</strong></p>" if total_parts > 1 else ""}
+        <br>
+        <p><em>💡 Para ver las imágenes, descarga y descomprime el archivo ZIP adjunto.</em></p>
+        <br>
+        <p>Nota: La imagen 5.png corresponde al record_id 5 del proyecto PRESIENTE LAB MUESTRAS HUMANAS y así con cada imagen dentro del zip<p>
+        <p><em>Enviado desde la aplicación de Streamlit</em></p>
+      </body>
+    </html>
+    """
+    em.add_alternative(html_body, subtype="html")
+
+    # Agregar archivo ZIP como adjunto
+    em.add_attachment(
+        image_data(zip_file),
+        maintype="application",
+        subtype="zip",
+        filename=zip_filename
+    )
+    return em
+
+def send_zip_parts(zip_parts, email_receiver, total_images, events):
+    """Enviar todas las partes por una sola conexión SMTP (corre en un hilo aparte).
+
+    Publica en `events` tuplas (índice_parte, estado, detalle) con estado
+    "enviando", "enviada" o "error", y al final (None, "fin", todas_enviadas).
+    Si el servidor corta la conexión se reabre una vez y se reintenta la parte.
+    """
+    sent = 0
+    current = 0
+    smtp = None
     try:
-        # Primero crear el archivo ZIP
-        zip_path = create_zip_file(attachment_files, record_ids)
-        
-        if not zip_path or not os.path.exists(zip_path):
+        smtp = open_smtp_connection()
+        for index, zip_file in enumerate(zip_parts):
+            current = index
+            events.put((index, "enviando", None))
+            em = build_zip_email(email_receiver, zip_file, total_images, index + 1, len(zip_parts))
+            try:
+                try:
+                    # send_message serializa directo a bytes, sin la copia extra de as_string()
+                    smtp.send_message(em, from_addr=email_sender, to_addrs=[email_receiver])
+                except smtplib.SMTPServerDisconnected:
+                    smtp = open_smtp_connection()
+                    smtp.send_message(em, from_addr=email_sender, to_addrs=[email_receiver])
+                events.put((index, "enviada", None))
+                sent += 1
+            except smtplib.SMTPResponseException as e:
+                # Rechazo de esta parte (p. ej. tamaño): seguir con las demás
+                events.put((index, "error", f"{e.smtp_code} {e.smtp_error.decode(errors='replace')}"))
+    except Exception as e:
+        for index in range(current, len(zip_parts)):
+            events.put((index, "error", str(e)))
+    finally:
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+        events.put((None, "fin", sent == len(zip_parts)))
+
+PART_STATUS_ICONS = {"en espera": "⏳", "enviando": "📤", "enviada": "✅", "error": "❌"}
+
+def send_email_with_zip(record_ids, attachment_files, email_receiver, in_memory=False, metrics=None,
+                        zip_parts=None):
+    """Enviar las imágenes de códigos de barras como uno o más ZIP adjuntos.
+
+    Las partes (creadas aquí si no se pasan en `zip_parts`) se envían desde un
+    hilo aparte mientras la interfaz muestra el estado de cada una.
+    """
+    metrics = metrics or CaptureMetrics()
+    try:
+        # Primero crear los archivos ZIP
+        if zip_parts is None:
+            with metrics.timed("zip"):
+                zip_parts = create_zip_parts(attachment_files, record_ids, in_memory=in_memory)
+
+        if not zip_parts:
             st.error("❌ No se pudo crear el archivo ZIP para el email")
             return False
-        
-        # Crear email
-        em = EmailMessage()
-        em['From'] = email_sender
-        em['To'] = email_receiver
-        em['Subject'] = f"Códigos de Barras RedCap Presiente Lab Muestras Humanas"
-
-        html_body = f"""
-        <html>
-          <body>
-            <h2>Códigos de Barras Descargados</h2>
-            <p><strong>Total de imágenes procesadas:</strong> {len(attachment_files)}</p>
-            <p><strong>Archivo adjunto:</strong> {os.path.basename(zip_path)} (formato ZIP)</p>
-            <br>
-            <p><em>💡 Para ver las imágenes, descarga y descomprime el archivo ZIP adjunto.</em></p>
-            <br>
-            <p>Nota: La imagen 5.png corresponde al record_id 5 del proyecto PRESIENTE LAB MUESTRAS HUMANAS y así con cada imagen dentro del zip<p>
-            <p><em>Enviado desde la aplicación de Streamlit</em></p>
-          </body>
-        </html>
-        """
-        em.add_alternative(html_body, subtype="html")
-
-        # Agregar archivo ZIP como adjunto
-        with open(zip_path, "rb") as f:
-            zip_filename = os.path.basename(zip_path)
-            em.add_attachment(
-                f.read(),
-                maintype="application",
-                subtype="zip",
-                filename=zip_filename
-            )
 
-        # Enviar email
-        st.info("📧 Enviando email con archivo ZIP adjunto...")
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context, timeout=30) as smtp:
-            smtp.login(email_sender, email_password)
-            smtp.sendmail(email_sender, email_receiver, em.as_string())
+        st.info(f"📧 Enviando {len(zip_parts)} email(s) con archivo ZIP adjunto...")
+        status = [st.empty() for _ in zip_parts]
+        labels = [f"{image_name(zip_file)} ({image_size(zip_file) / (1024 * 1024):.2f} MB)" for zip_file in zip_parts]
+        for placeholder, label in zip(status, labels):
+            placeholder.write(f"{PART_STATUS_ICONS['en espera']} {label}: en espera")
 
-        return True
+        events = queue.Queue()
+        sender = threading.Thread(
+            target=send_zip_parts,
+            args=(zip_parts, email_receiver, len(attachment_files), events),
+            daemon=True,
+        )
+        start = time.perf_counter()
+        sender.start()
+
+        # Solo el hilo principal toca la interfaz
+        while True:
+            index, state, detail = events.get()
+            if index is None:
+                all_sent = detail
+                break
+            message = f"{PART_STATUS_ICONS[state]} {labels[index]}: {state}"
+            status[index].write(f"{message} — {detail}" if detail else message)
+
+        sender.join()
+        metrics.record("smtp", time.perf_counter() - start)
+        return all_sent
 
     except Exception as e:
         st.error(f"❌ Fallo en el envío del email: {e}")
         return False
 
+# =========================================
+# Galería de Miniaturas
+# =========================================
+GALLERY_PAGE_SIZE = 24
+THUMBNAIL_WIDTH = 360
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def barcode_thumbnail(zip_digest, member, _zip_bytes, width=THUMBNAIL_WIDTH):
+    """Miniatura PNG de una imagen dentro de un ZIP en memoria.
+
+    La caché es compartida por todas las sesiones: la clave es el hash del ZIP
+    (calculado una vez por parte) y el nombre del archivo, no los bytes.
+    """
+    from PIL import Image
+
+    with zipfile.ZipFile(io.BytesIO(_zip_bytes)) as zipf:
+        img = Image.open(io.BytesIO(zipf.read(member)))
+        img.thumbnail((width, width))
+    output = io.BytesIO()
+    img.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+@st.fragment
+def show_gallery(zip_parts, digests):
+    """Galería paginada a partir de los ZIP en memoria.
+
+    `digests` (SHA-1 de cada ZIP, calculados una vez al crearlos) identifican
+    las miniaturas en caché. Solo se generan las de la página visible y
+    cambiar de página re-ejecuta únicamente esta sección.
+    """
+    entries = []
+    for part_idx, (_, zip_bytes) in enumerate(zip_parts):
+        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipf:
+            # El manifiesto CSV viaja en el mismo ZIP
+            entries.extend((part_idx, member) for member in zipf.namelist() if member.endswith(".png"))
+    if not entries:
+        return
+
+    st.subheader(f"📸 Imágenes de Códigos de Barras Descargadas ({len(entries)}):")
+    num_pages = (len(entries) + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+    page = 1
+    if num_pages > 1:
+        page = st.number_input(f"Página (de {num_pages})", min_value=1, max_value=num_pages, value=1, key="galeria_pagina")
+
+    visible = entries[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]
+    cols = st.columns(min(3, len(visible)))
+    for i, (part_idx, member) in enumerate(visible):
+        _, zip_bytes = zip_parts[part_idx]
+        with cols[i % len(cols)]:
+            st.image(barcode_thumbnail(digests[part_idx], member, zip_bytes), caption=f"ID: {member.split('.')[0]}")
+
+def show_zip_downloads(zip_parts, started_at=None, key="descargar"):
+    """Botones para descargar los ZIP directamente, como alternativa al email.
+
+    Con `started_at` (inicio de la captura), descargar una parte la anota
+    como entregada en el manifiesto. `key` distingue los botones de cada panel.
+    """
+    st.subheader("📥 Descargar ZIP")
+    for zip_filename, zip_bytes in zip_parts:
+        st.download_button(
+            label=f"📦 {zip_filename} ({len(zip_bytes) / (1024 * 1024):.2f} MB)",
+            data=zip_bytes,
+            file_name=zip_filename,
+            mime="application/zip",
+            key=f"{key}_{zip_filename}",
+            on_click=register_zip_download if started_at else "rerun",
+            args=(zip_bytes, started_at) if started_at else None,
+        )
+
+# =========================================
+# Ingesta de Record IDs (CSV y Rangos)
+# =========================================
+ORDER_INPUT = "Orden ingresado"
+ORDER_ASCENDING = "Ascendente"
+
+# Sobre este tamaño el CSV se lee por bloques en lugar de una sola pasada con pyarrow
+CSV_CHUNKED_MB = 50
+CSV_CHUNK_ROWS = 200_000
+# Tope de IDs que puede generar un solo rango "inicio-fin" escrito a mano
+MAX_RANGE_IDS = 100_000
+# Record ID válido: entero no negativo de hasta 18 dígitos (cabe en int64); se tolera un ".0" de Excel
+RECORD_ID_PATTERN = r"\d{1,18}(?:\.0+)?"
+RANGE_PATTERN = re.compile(r"(\d{1,18})\s*-\s*(\d{1,18})")
+
+def read_record_id_column(csv_file):
+    """Leer solo la columna record_id (como texto) de un CSV subido.
+
+    Lanza ValueError si el CSV no tiene la columna.
+    """
+    columns = pd.read_csv(csv_file, nrows=0).columns
+    csv_file.seek(0)
+    if "record_id" not in columns:
+        raise ValueError("El CSV no contiene una columna llamada 'record_id'.")
+
+    # dtype "string": las celdas vacías quedan como <NA> en ambos motores (con str, pyarrow las vuelve "None")
+    if getattr(csv_file, "size", 0) <= CSV_CHUNKED_MB * 1024 * 1024:
+        return pd.read_csv(csv_file, usecols=["record_id"], dtype="string", engine="pyarrow")["record_id"]
+
+    # El motor pyarrow no admite chunksize
+    chunks = pd.read_csv(csv_file, usecols=["record_id"], dtype="string", chunksize=CSV_CHUNK_ROWS)
+    return pd.concat((chunk["record_id"] for chunk in chunks), ignore_index=True)
+
+def normalize_record_ids(values, order=ORDER_INPUT):
+    """Validar, deduplicar y ordenar Record IDs.
+
+    Retorna (ids, invalid, duplicates): los IDs enteros únicos en el orden
+    pedido, los valores inválidos (negativos, decimales, notación científica,
+    texto) y la cantidad de duplicados descartados. Los vacíos se ignoran.
+    """
+    values = pd.Series(values, dtype=object)
+    text = values.astype("string[pyarrow]").str.strip()
+    valid = text.str.fullmatch(RECORD_ID_PATTERN).fillna(False).astype(bool)
+    invalid = values[~valid & text.notna() & (text != "")]
+
+    ids = pd.to_numeric(text[valid].str.replace(r"\.0+$", "", regex=True)).astype(np.int64).to_numpy()
+    unique_ids = pd.unique(ids)  # Conserva el orden de la primera aparición
+    if order == ORDER_ASCENDING:
+        unique_ids = np.sort(unique_ids)
+    return unique_ids.tolist(), invalid.tolist(), len(ids) - len(unique_ids)
+
+def parse_manual_ids(text):
+    """Convertir "1, 5, 1000-1500" en valores; retorna (valores, tokens_inválidos).
+
+    Solo "entero-entero" es un rango; "-5" o "1e3" pasan como valores y
+    normalize_record_ids los reporta como inválidos.
+    """
+    values = []
+    invalid = []
+    for token in text.replace(";", ",").replace("\n", ",").split(","):
+        token = token.strip()
+        if not token:
+            continue
+        match = RANGE_PATTERN.fullmatch(token)
+        if match:
+            start, end = int(match[1]), int(match[2])
+            if start > end or end - start + 1 > MAX_RANGE_IDS:
+                invalid.append(token)
+            else:
+                values.extend(range(start, end + 1))
+        else:
+            values.append(token)
+    return values, invalid
+
+def summarize_ids(record_ids, max_runs=8):
+    """Resumen compacto como "1-3, 7, 10-500 … (+12 tramos)" en lugar de la lista completa"""
+    ids = np.asarray(record_ids)
+    if ids.size == 0:
+        return ""
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = ids[np.r_[0, breaks]]
+    ends = ids[np.r_[breaks - 1, ids.size - 1]]
+    text = ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in zip(starts[:max_runs], ends[:max_runs]))
+    if starts.size > max_runs:
+        text += f" … (+{starts.size - max_runs} tramos)"
+    return text
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def ingest_manual_ids(text, order=ORDER_INPUT):
+    """parse_manual_ids + normalize_record_ids, en caché por texto y orden.
+
+    Retorna (ids, inválidos, duplicados, rangos_inválidos).
+    """
+    values, invalid_ranges = parse_manual_ids(text)
+    record_ids, invalid, duplicates = normalize_record_ids(values, order)
+    return record_ids, invalid, duplicates, invalid_ranges
+
+@st.cache_data(max_entries=4, show_spinner="Leyendo CSV...")
+def ingest_csv_ids(file_id, _csv_file, order=ORDER_INPUT):
+    """Leer y validar un CSV subido una sola vez por archivo.
+
+    La clave es el `file_id` que Streamlit asigna a cada carga (no el
+    contenido), así que un acierto no depende del tamaño del archivo. Retorna
+    (vista_previa, filas, ids, inválidos, duplicados).
+    """
+    values = read_record_id_column(_csv_file)
+    record_ids, invalid, duplicates = normalize_record_ids(values, order)
+    return values.head(10).to_frame(), len(values), record_ids, invalid, duplicates
+
+def show_ingestion_summary(record_ids, invalid, duplicates, max_invalid=20):
+    """Avisos de valores inválidos y duplicados, sin volcar listas completas"""
+    if invalid:
+        st.warning(
+            f"⚠️ Se omitieron {len(invalid)} valores no válidos: "
+            f"{', '.join(map(str, invalid[:max_invalid]))}{' …' if len(invalid) > max_invalid else ''}"
+        )
+    if duplicates:
+        st.info(f"🔁 Se descartaron {duplicates} Record IDs duplicados (cada duplicado costaría una carga de página).")
+    if record_ids:
+        st.caption(f"📋 {len(record_ids)} Record IDs únicos: {summarize_ids(record_ids)}")
+
 # =========================================
 # Función de Procesamiento de CSV
 # =========================================
-def process_csv_upload():
+def process_csv_upload(order=ORDER_INPUT):
     """Manejar la carga y validación de CSV para record IDs"""
     st.subheader("📁 Cargar CSV con Record IDs")
     
@@ -319,48 +2578,29 @@ def process_csv_upload():
     
     if uploaded_file is not None:
         try:
-            # Leer CSV
-            df = pd.read_csv(uploaded_file)
-            
-            # Verificar si existe la columna 'record_id'
-            if "record_id" not in df.columns:
-                st.error("❌ El CSV no contiene una columna llamada 'record_id'.")
+            # Leer solo la columna 'record_id' (en caché por archivo)
+            try:
+                preview, total_rows, record_ids, invalid, duplicates = ingest_csv_ids(
+                    uploaded_file.file_id, uploaded_file, order
+                )
+            except ValueError as e:
+                st.error(f"❌ {e}")
                 return None
             
             # Mostrar vista previa de datos cargados
             st.subheader("📊 Vista Previa de Datos Cargados")
-            st.dataframe(df.head(10), use_container_width=True, hide_index=True)
-            st.info(f"Total de filas en CSV: {len(df)}")
+            st.dataframe(preview, use_container_width=True, hide_index=True)
+            st.info(f"Total de filas en CSV: {total_rows}")
             
-            # Convertir a numérico y validar
-            df["record_id_numeric"] = pd.to_numeric(df["record_id"], errors="coerce")
+            show_ingestion_summary(record_ids, invalid, duplicates)
             
-            # Detectar valores no numéricos
-            invalid_values = df.loc[df["record_id_numeric"].isnull(), "record_id"]
-            
-            if not invalid_values.empty:
-                st.warning("⚠️ Se encontraron valores no numéricos en 'record_id':")
-                st.write(invalid_values.tolist())
-                st.info("Solo se procesarán los valores numéricos válidos.")
-            
-            # Procesar solo valores numéricos válidos
-            valid_df = df.dropna(subset=["record_id_numeric"]).copy()
-            
-            if len(valid_df) == 0:
+            if not record_ids:
                 st.error("❌ No se encontraron record IDs numéricos válidos en el CSV.")
                 return None
             
-            # Convertir a enteros
-            valid_df["record_id_int"] = valid_df["record_id_numeric"].astype(int)
-            record_ids = valid_df["record_id_int"].tolist()
-            
             # Mostrar resultados de validación
             st.success(f"✅ Se encontraron {len(record_ids)} record IDs válidos")
             
-            # Mostrar IDs válidos
-            with st.expander(f"📋 Record IDs Válidos ({len(record_ids)} elementos)"):
-                st.write(record_ids)
-            
             return record_ids
             
         except Exception as e:
@@ -378,139 +2618,428 @@ def check_system_requirements():
     
     checks = []
     
-    # Verificar disponibilidad de Chrome
+    # Verificar disponibilidad de Chrome (y dejar un driver con sesión listo en el pool)
     try:
-        chrome_options = Options()
-        chrome_options.add_argument("--headless=new")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.quit()
+        pool = get_driver_pool(redcap_username, redcap_password)
+        driver = pool.acquire(timeout=60)
+        pool.release(driver)
         checks.append(("✅", "Navegador Chrome", "Disponible"))
+        stats = pool.stats()
+        checks.append(("✅", "Sesión de RedCap", f"Iniciada ({stats['total']} drivers en el pool, {stats['libres']} libres)"))
     except Exception as e:
         checks.append(("❌", "Navegador Chrome", f"No disponible: {str(e)[:50]}..."))
+
+    admission = get_browser_admission().stats()
+    checks.append((
+        "✅" if admission["chrome_vivos"] < admission["maximo"] else "⚠️",
+        "Cupo de Chrome",
+        f"{admission['chrome_vivos']}/{admission['maximo']} instancias, "
+        f"{admission['en_cola']} capturas en cola en esta app (sin contar trabajos en segundo plano), "
+        f"{admission['memoria_libre_mb']:.0f} MB libres",
+    ))
     
     # Mostrar verificaciones
     for status, component, message in checks:
         st.write(f"{status} **{component}**: {message}")
     
-    return all(check[0] == "✅" for check in checks)
+    # "⚠️" es informativo (p. ej. cupo de Chrome lleno), no un requisito faltante
+    return all(check[0] != "❌" for check in checks)
+
+@st.fragment
+def system_check_section():
+    """Verificación del sistema; su botón re-ejecuta solo esta sección"""
+    with st.expander("🔧 Verificación del Sistema"):
+        if st.button("Ejecutar Verificación del Sistema"):
+            system_ok = check_system_requirements()
+            if not system_ok:
+                st.warning("⚠️ Algunos requisitos del sistema están faltando. La aplicación podría no funcionar correctamente.")
 
 # =========================================
-# Interfaz de Usuario de Streamlit
+# Reporte de Tiempos de la Captura
 # =========================================
-st.markdown("<h1 style='font-size: 20px;'>Descargar códigos de barras de RedCap (PRESIENTE LAB MUESTRAS HUMANAS) y enviar por Email</h1>", unsafe_allow_html=True)
-st.write("Ingresa Record IDs manualmente o carga un archivo CSV para descargar imágenes de códigos de barras desde RedCap y enviarlas por email.")
+def show_metrics_report(metrics):
+    """Resumen p50/p95 por etapa, histograma por ID, memoria y reciclajes, y descarga de los tiempos crudos"""
+    summary = metrics.summary()
+    if summary.empty:
+        return
+
+    with st.expander("⏱️ Reporte de Tiempos por Etapa"):
+        st.dataframe(summary, use_container_width=True)
+
+        totals = metrics.per_record_totals()
+        if not totals.empty:
+            counts, edges = np.histogram(totals, bins=min(20, max(1, len(totals))))
+            histogram = pd.DataFrame(
+                {"IDs": counts},
+                index=[f"{edges[i]:.1f}-{edges[i + 1]:.1f}s" for i in range(len(counts))],
+            )
+            st.caption("Segundos por Record ID")
+            st.bar_chart(histogram)
+
+        kb_by_profile = st.session_state.get("kb_por_pagina", {})
+        if kb_by_profile:
+            # Último valor medido con cada perfil, para comparar antes/después
+            st.caption("KB transferidos por página")
+            st.dataframe(
+                pd.DataFrame({"perfil": list(kb_by_profile), "kb_por_pagina": [round(v, 1) for v in kb_by_profile.values()]}),
+                hide_index=True,
+            )
+
+        memory = metrics.memory_frame().dropna(subset=["rss_mb"])
+        if not memory.empty:
+            st.caption(f"Memoria por driver (MB) según páginas visitadas: máx. {memory['rss_mb'].max():.0f} MB")
+            curves = memory.pivot_table(index="pagina", columns="driver", values="rss_mb", aggfunc="last")
+            curves.columns = [f"driver {int(number)}" for number in curves.columns]
+            st.line_chart(curves)
 
-# Sección de verificación del sistema
-with st.expander("🔧 Verificación del Sistema"):
-    if st.button("Ejecutar Verificación del Sistema"):
-        system_ok = check_system_requirements()
-        if not system_ok:
-            st.warning("⚠️ Algunos requisitos del sistema están faltando. La aplicación podría no funcionar correctamente.")
+        recycles = metrics.recycles_frame()
+        if not recycles.empty:
+            st.caption(f"♻️ {len(recycles)} drivers reciclados por el vigilante de memoria")
+            st.dataframe(recycles, use_container_width=True, hide_index=True)
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        col_csv, col_json = st.columns(2)
+        with col_csv:
+            st.download_button(
+                label="📥 Tiempos (CSV)",
+                data=metrics.to_csv(),
+                file_name=f"tiempos_captura_{timestamp}.csv",
+                mime="text/csv",
+            )
+        with col_json:
+            st.download_button(
+                label="📥 Tiempos (JSON)",
+                data=metrics.to_json(),
+                file_name=f"tiempos_captura_{timestamp}.json",
+                mime="application/json",
+            )
 
 # =========================================
-# Selección de Método de Entrada
+# Trabajos en Segundo Plano
 # =========================================
-st.subheader("🎯 Elegir Método de Entrada")
-input_method = st.radio(
-    "¿Cómo te gustaría proporcionar los Record IDs?",
-    ["Entrada Manual", "Carga de CSV"],
-    horizontal=True
-)
+def get_job_store():
+    """Almacén de trabajos en segundo plano (el worker lo abre igual, con los mismos secrets)"""
+    return jobs.JobStore(st.secrets.get("jobs_db_path", jobs.JOBS_DB_PATH))
+
+@st.cache_resource
+def resume_interrupted_jobs():
+    """Relanzar (una vez por proceso) los trabajos cortados por un reinicio del contenedor"""
+    store = get_job_store()
+    resumed = store.interrupted_jobs()
+    for job_id in resumed:
+        jobs.start_worker(job_id, store)
+    return resumed
 
-record_ids = []
+def show_job_fallback(store, job):
+    """Reintentar solo el email de un trabajo terminado, o descargar sus imágenes en ZIP"""
+    job_id = job["id"]
+    if not store.progress(job_id)["done"]:
+        return
+    if job["email_receiver"] and st.button("📧 Reintentar envío del email", key=f"reenviar_{job_id}"):
+        # Sin recapturar: las imágenes ya están en el checkpoint del trabajo
+        if jobs.email_job(store, job_id):
+            st.success(f"✅ Email enviado a {job['email_receiver']}")
 
-# Método de entrada manual
-if input_method == "Entrada Manual":
-    st.subheader("✍️ Entrada Manual")
-    record_ids_input = st.text_input(
-        "Ingresa Record IDs separados por comas", 
-        placeholder="ej., 1,2,3,4,5",
-        value="1,2,3"
+    zip_key = f"zip_trabajo_{job_id}"
+    if zip_key not in st.session_state and st.button("📦 Preparar ZIP para descargar", key=f"preparar_zip_{job_id}"):
+        attachments = register_capture(store.images(job_id), job["options"].get("manifest_csv", False))
+        st.session_state[zip_key] = create_zip_parts(attachments, store.record_ids(job_id), in_memory=True)
+    if zip_key in st.session_state:
+        show_zip_downloads(st.session_state[zip_key], started_at=job["created_at"], key=f"trabajo_{job_id}")
+
+@st.fragment(run_every=2)
+def show_job_progress(job_id):
+    """Panel de progreso de un trabajo; se refresca solo, sin rerun de toda la app"""
+    store = get_job_store()
+    job = store.get_job(job_id)
+    if job is None:
+        st.warning(f"⚠️ No existe el trabajo #{job_id}")
+        return
+
+    counts = store.progress(job_id)
+    total = sum(counts.values())
+    finished = counts["done"] + counts["failed"]
+    st.progress(finished / total if total else 1.0)
+    st.write(
+        f"**Trabajo #{job_id}** — {job['status']}: {counts['done']} capturados, "
+        f"{counts['failed']} fallidos, {counts['pending']} pendientes de {total}"
     )
-    
-    if record_ids_input.strip():
-        try:
-            # Parsear Record IDs
-            for rid in record_ids_input.split(","):
-                rid = rid.strip()
-                if rid:
-                    try:
-                        record_ids.append(int(rid))
-                    except ValueError:
-                        st.warning(f"⚠️ '{rid}' no es un número válido, omitiendo.")
-        except Exception as e:
-            st.error(f"❌ Error al parsear Record IDs: {e}")
 
-# Método de carga de CSV
-elif input_method == "Carga de CSV":
-    csv_record_ids = process_csv_upload()
-    if csv_record_ids:
-        record_ids = csv_record_ids
+    if job["status"] == jobs.DONE:
+        if job["emailed"]:
+            st.success(f"✅ Email enviado a {job['email_receiver']}")
+        else:
+            st.warning("⚠️ El trabajo terminó pero no se envió el email")
+            show_job_fallback(store, job)
+    elif job["status"] == jobs.FAILED:
+        st.error(f"❌ El trabajo se detuvo: {job['error']}")
+
+    can_resume = job["status"] == jobs.FAILED or (
+        job["status"] != jobs.DONE and not jobs.is_process_alive(job["pid"], job_id)
+    )
+    if can_resume and st.button("▶️ Reanudar trabajo", key=f"reanudar_{job_id}"):
+        jobs.start_worker(job_id, store)
+        st.info(f"🔄 Trabajo #{job_id} reanudado desde el último ID terminado")
 
 # =========================================
-# Entrada de Email y Procesamiento
+# Interfaz de Usuario de Streamlit
 # =========================================
-if record_ids:
-    st.subheader("📧 Configuración de Email")
-    st.success(f"✅ Listo para procesar {len(record_ids)} Record IDs: {record_ids[:10]}{'...' if len(record_ids) > 10 else ''}")
-    
-    email_receiver_input = st.text_input(
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+@st.fragment
+def email_input_section():
+    """Campo del destinatario; escribir en él re-ejecuta solo esta sección.
+
+    El resto de la página lee el valor desde st.session_state["email_destinatario"].
+    """
+    email = st.text_input(
         "Ingresa Email del Destinatario",
-        placeholder="ejemplo@dominio.com"
+        placeholder="ejemplo@dominio.com",
+        help="Opcional: sin email, los ZIP quedan disponibles para descargar desde esta página.",
+        key="email_destinatario",
     )
-    
-    # Sección de procesamiento
-    if st.button("🚀 Descargar Códigos de Barras y Enviar Email", type="primary"):
-        if not email_receiver_input.strip():
-            st.error("❌ Por favor ingresa un email del destinatario")
-        else:
+    if email.strip() and not EMAIL_PATTERN.match(email.strip()):
+        st.warning("⚠️ El email no parece válido")
+
+def main():
+    st.markdown("<h1 style='font-size: 20px;'>Descargar códigos de barras de RedCap (PRESIENTE LAB MUESTRAS HUMANAS) y enviar por Email</h1>", unsafe_allow_html=True)
+    st.write("Ingresa Record IDs manualmente o carga un archivo CSV para descargar imágenes de códigos de barras desde RedCap y enviarlas por email.")
+
+    # Sección de verificación del sistema
+    system_check_section()
+
+    # Trabajos en segundo plano (el enlace ?trabajo=<id> sobrevive a un refresco)
+    resume_interrupted_jobs()
+    if st.query_params.get("trabajo", "").isdigit():
+        st.subheader("⏳ Trabajo en Segundo Plano")
+        st.caption("Puedes cerrar esta página y volver con el mismo enlace.")
+        show_job_progress(int(st.query_params["trabajo"]))
+
+    # =========================================
+    # Selección de Método de Entrada
+    # =========================================
+    st.subheader("🎯 Elegir Método de Entrada")
+    input_method = st.radio(
+        "¿Cómo te gustaría proporcionar los Record IDs?",
+        ["Entrada Manual", "Carga de CSV"],
+        horizontal=True
+    )
+
+    id_order = st.radio(
+        "Orden de captura",
+        [ORDER_INPUT, ORDER_ASCENDING],
+        horizontal=True,
+        help="Los Record IDs duplicados se descartan en ambos casos."
+    )
+
+    record_ids = []
+
+    # Método de entrada manual
+    if input_method == "Entrada Manual":
+        st.subheader("✍️ Entrada Manual")
+        record_ids_input = st.text_input(
+            "Ingresa Record IDs separados por comas (acepta rangos)", 
+            placeholder="ej., 1,2,3,1000-1500",
+            value="1,2,3"
+        )
+
+        if record_ids_input.strip():
             try:
-                st.info(f"🎯 Procesando {len(record_ids)} Record IDs...")
-                
-                # Descargar imágenes de códigos de barras
-                with st.spinner("📥 Descargando imágenes de códigos de barras..."):
-                    downloaded_files = download_barcode_images(record_ids, redcap_username, redcap_password)
-
-                if downloaded_files:
-                    st.success(f"✅ ¡Se descargaron exitosamente {len(downloaded_files)} imágenes de códigos de barras!")
-
-                    # Mostrar imágenes descargadas
-                    st.subheader("📸 Imágenes de Códigos de Barras Descargadas:")
-                    cols = st.columns(min(3, len(downloaded_files)))
-                    for i, file_path in enumerate(downloaded_files):
-                        col_idx = i % len(cols)
-                        with cols[col_idx]:
-                            if os.path.exists(file_path):
-                                st.image(file_path, caption=f"ID: {os.path.basename(file_path).split('.')[0]}")
-
-                    # Enviar email con ZIP - LLAMADA ACTUALIZADA
-                    with st.spinner("📧 Creando archivo ZIP y enviando email..."):
-                        if send_email_with_zip(record_ids, downloaded_files, email_receiver_input):
-                            st.success("✅ ¡Email enviado exitosamente con archivo ZIP de códigos de barras adjunto!")
-                            
-                            # Mostrar información del ZIP
-                            zip_files = [f for f in os.listdir("codigos_barras") if f.endswith('.zip')]
-                            if zip_files:
-                                zip_file = zip_files[0]
-                                zip_path = os.path.join("codigos_barras", zip_file)
-                                if os.path.exists(zip_path):
-                                    zip_size = os.path.getsize(zip_path) / (1024 * 1024)
-                                    st.info(f"📦 Detalles del archivo ZIP: {zip_file} ({zip_size:.2f} MB)")
-                            
-                            # Limpieza
-                            try:
-                                shutil.rmtree("codigos_barras")
-                                st.info("🧹 Archivos temporales limpiados")
-                            except:
-                                pass
-                        else:
-                            st.error("❌ Fallo al enviar el email")
+                # Parsear Record IDs y rangos
+                record_ids, invalid, duplicates, invalid_ranges = ingest_manual_ids(record_ids_input, id_order)
+                for token in invalid_ranges:
+                    st.warning(f"⚠️ '{token}' no es un rango válido (máximo {MAX_RANGE_IDS} IDs), omitiendo.")
+                show_ingestion_summary(record_ids, invalid, duplicates)
+            except Exception as e:
+                st.error(f"❌ Error al parsear Record IDs: {e}")
+
+    # Método de carga de CSV
+    elif input_method == "Carga de CSV":
+        csv_record_ids = process_csv_upload(id_order)
+        if csv_record_ids:
+            record_ids = csv_record_ids
+
+    # =========================================
+    # Entrada de Email y Procesamiento
+    # =========================================
+    if record_ids:
+        st.subheader("📧 Configuración de Email")
+        st.success(f"✅ Listo para procesar {len(record_ids)} Record IDs: {summarize_ids(record_ids, max_runs=4)}")
+
+        email_input_section()
+        email_receiver_input = st.session_state.get("email_destinatario", "")
+
+        capture_engine = st.radio(
+            "Motor de captura",
+            [ENGINE_SELENIUM, ENGINE_API],
+            horizontal=True,
+            help="El motor sin navegador exporta los valores por la API de RedCap y dibuja los códigos de barras localmente."
+        )
+
+        use_cache = st.checkbox(
+            "Reutilizar códigos de barras en caché",
+            value=True,
+            help="Solo se capturan los Record IDs que no se descargaron en ejecuciones anteriores."
+        )
+        validate_cache = st.checkbox(
+            "Invalidar caché de records modificados en RedCap",
+            value=bool(redcap_api_token),
+            disabled=not (use_cache and redcap_api_token),
+            help="Consulta la fecha de modificación por la API de RedCap (requiere 'redcap_api_token')."
+        )
+
+        in_memory = st.checkbox(
+            "Pipeline en memoria (sin archivos temporales)",
+            value=False,
+            help="Las capturas se recortan y comprimen en memoria; no se escribe nada en disco salvo la caché."
+        )
+
+        max_workers = os.cpu_count() or 1
+        num_workers = st.number_input(
+            "Sesiones de Chrome en paralelo",
+            min_value=1,
+            max_value=max_workers,
+            value=1,
+            help=f"Cada sesión es un Chrome sin cabeza independiente. Este contenedor tiene {max_workers} núcleos."
+        )
+
+        # Las pestañas en pipeline (options["tabs"]) quedan fuera de la interfaz hasta medirlas
+        # contra un Chrome real con benchmark.py --tabs; por ahora solo las usa el benchmark.
+
+        lean_profile = st.checkbox(
+            "Perfil de captura liviano",
+            value=False,
+            help="Carga 'eager' y bloquea fuentes, medios y analítica (CDP) en las páginas de RedCap."
+        )
+
+        compact = st.checkbox(
+            "Recorte automático y PNG de 1 bit",
+            value=False,
+            help="Recorta cada imagen al código de barras con un margen y la guarda en blanco y negro (ZIP más liviano)."
+        )
+        compact_batch = st.checkbox(
+            "Compactar en lote al final (varios procesos)",
+            value=False,
+            disabled=not compact,
+            help="En lugar de compactar cada imagen al capturarla, procesa todas al final en un pool de procesos."
+        )
+
+        delta_mode = st.checkbox(
+            "Modo delta: solo records nuevos o modificados",
+            value=False,
+            help="Usa el manifiesto local de entregas y la fecha de modificación de la API de RedCap "
+                 "para omitir los records ya entregados sin cambios."
+        )
+        include_manifest = st.checkbox(
+            "Adjuntar manifiesto CSV completo",
+            value=False,
+            help="Agrega al ZIP un CSV con todos los Record IDs capturados y entregados, sus fechas y el hash de cada imagen."
+        )
+
+        run_in_background = st.checkbox(
+            "Ejecutar en segundo plano (reanudable)",
+            value=len(record_ids) > 200,
+            help="La captura sigue aunque se cierre el navegador y se reanuda tras un reinicio del contenedor."
+        )
+
+        options = {
+            "engine": capture_engine,
+            "num_workers": int(num_workers),
+            "use_cache": use_cache,
+            "validate_cache": validate_cache,
+            "lean": lean_profile,
+            "compact": compact,
+            "compact_batch": compact_batch,
+            "manifest_csv": include_manifest,
+        }
+
+        # Sección de procesamiento
+        if st.button("🚀 Descargar Códigos de Barras y Enviar Email", type="primary"):
+            if run_in_background and not email_receiver_input.strip():
+                st.error("❌ Por favor ingresa un email del destinatario (requerido en segundo plano)")
+            elif run_in_background:
+                delta_statuses, capture_ids = select_delta_ids(record_ids) if delta_mode else (None, record_ids)
+                if not capture_ids:
+                    st.success("✅ No hay records nuevos ni modificados desde la última entrega")
                 else:
-                    st.error("❌ No se descargaron exitosamente imágenes de códigos de barras")
-                    st.info("💡 Intenta ejecutar la verificación del sistema para identificar problemas potenciales.")
+                    store = get_job_store()
+                    job_id = store.create_job(capture_ids, email_receiver_input.strip(), options)
+                    jobs.start_worker(job_id, store)
+                    # El panel de progreso se muestra arriba; el enlace sirve para volver más tarde
+                    st.query_params["trabajo"] = str(job_id)
+                    st.rerun()
+            else:
+                try:
+                    # Lo modificado en RedCap desde este momento entra en la próxima entrega
+                    run_started = time.time()
+                    delta_statuses, capture_ids = select_delta_ids(record_ids) if delta_mode else (None, record_ids)
+                    if not capture_ids:
+                        st.success("✅ No hay records nuevos ni modificados desde la última entrega")
+                        st.stop()
+                    st.info(f"🎯 Procesando {len(capture_ids)} Record IDs...")
 
-            except Exception as e:
-                st.error(f"❌ Error de procesamiento: {e}")
-                st.exception(e)
\ No newline at end of file
+                    # Descargar imágenes de códigos de barras
+                    metrics = CaptureMetrics()
+                    with st.spinner("📥 Descargando imágenes de códigos de barras..."):
+                        downloaded_files = run_capture(
+                            capture_ids,
+                            options,
+                            save_image_in_memory if in_memory else save_image_to_disk,
+                            metrics=metrics,
+                        )
+
+                    if downloaded_files:
+                        st.success(f"✅ ¡Se descargaron exitosamente {len(downloaded_files)} imágenes de códigos de barras!")
+
+                        attachments = register_capture(downloaded_files, include_manifest, delta_statuses)
+                        with st.spinner("📦 Creando archivos ZIP..."):
+                            with metrics.timed("zip"):
+                                zip_parts = create_zip_parts(attachments, capture_ids, in_memory=in_memory)
+                        # Copia en memoria para la galería y los botones de descarga (los ZIP en disco se borran abajo)
+                        st.session_state["partes_zip"] = [(image_name(part), image_data(part)) for part in zip_parts]
+                        st.session_state["digestos_zip"] = [
+                            hashlib.sha1(zip_bytes).hexdigest() for _, zip_bytes in st.session_state["partes_zip"]
+                        ]
+                        st.session_state["inicio_captura"] = run_started
+
+                        # Enviar email con ZIP - LLAMADA ACTUALIZADA
+                        if email_receiver_input.strip() and zip_parts:
+                            if send_email_with_zip(capture_ids, downloaded_files, email_receiver_input.strip(),
+                                                   in_memory=in_memory, metrics=metrics, zip_parts=zip_parts):
+                                register_delivery(downloaded_files, email_receiver_input.strip(), run_started)
+                                st.success("✅ ¡Email enviado exitosamente con archivo ZIP de códigos de barras adjunto!")
+                            else:
+                                st.error("❌ Fallo al enviar el email; los ZIP siguen disponibles para descargar abajo")
+
+                        # Limpieza
+                        try:
+                            shutil.rmtree("codigos_barras")
+                            st.info("🧹 Archivos temporales limpiados")
+                        except:
+                            pass
+                    else:
+                        st.error("❌ No se descargaron exitosamente imágenes de códigos de barras")
+                        st.info("💡 Intenta ejecutar la verificación del sistema para identificar problemas potenciales.")
+
+                    # Se guarda para que el reporte siga visible tras usar sus botones de descarga
+                    st.session_state["metricas_captura"] = metrics
+                    kb_per_page = metrics.kb_per_page()
+                    if kb_per_page is not None:
+                        profile = "liviano" if lean_profile else "normal"
+                        st.session_state.setdefault("kb_por_pagina", {})[profile] = kb_per_page
+
+                except Exception as e:
+                    st.error(f"❌ Error de procesamiento: {e}")
+                    st.exception(e)
+
+        if st.session_state.get("partes_zip"):
+            # Se muestran fuera del botón para que sobrevivan a los reruns (paginación, descargas)
+            show_gallery(st.session_state["partes_zip"], st.session_state["digestos_zip"])
+            # Sin email, la entrega se anota cuando se descarga cada ZIP
+            show_zip_downloads(st.session_state["partes_zip"], st.session_state.get("inicio_captura"))
+
+        if "metricas_captura" in st.session_state:
+            show_metrics_report(st.session_state["metricas_captura"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Recorte automático de códigos de barras y codificación PNG compacta.
+
+Vive en su propio módulo (solo NumPy y PIL) para que los procesos de
+`compact_png_batch` puedan importarlo sin cargar Streamlit ni Selenium.
+"""
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# Transiciones claro/oscuro mínimas para que una fila se considere parte de las barras
+MIN_BAR_TRANSITIONS = 20
+# Separación máxima (px) entre barras de un mismo código
+MAX_BAR_GAP = 30
+# Filas claras que se toleran al extender el recorte hacia el texto del código
+MAX_TEXT_GAP = 8
+
+def find_barcode_bbox(dark):
+    """Caja (izq, arriba, der, abajo) del código de barras en una máscara booleana de píxeles oscuros.
+
+    Las filas de barras tienen muchas transiciones claro/oscuro; las columnas de
+    barras son oscuras en la mayoría de esas filas. Luego se extiende la caja
+    hacia arriba y abajo para incluir el texto legible del código. Retorna None
+    si no hay nada oscuro.
+    """
+    if not dark.any():
+        return None
+
+    transitions = np.count_nonzero(np.diff(dark, axis=1), axis=1)
+    bar_rows = np.flatnonzero(transitions >= MIN_BAR_TRANSITIONS)
+    if bar_rows.size == 0:
+        # Sin patrón de barras: caja de todo lo oscuro
+        rows = np.flatnonzero(dark.any(axis=1))
+        cols = np.flatnonzero(dark.any(axis=0))
+        return cols[0], rows[0], cols[-1], rows[-1]
+
+    top, bottom = bar_rows[0], bar_rows[-1]
+    # Bordes de barra: columnas donde la mayoría de las filas de barras cambia de tono.
+    # El grupo más grande de bordes cercanos es el código; bordes de tabla o texto quedan fuera.
+    edges = np.flatnonzero(np.diff(dark[top:bottom + 1], axis=1).mean(axis=0) > 0.5)
+    if edges.size == 0:
+        cols = np.flatnonzero(dark[top:bottom + 1].any(axis=0))
+        left, right = cols[0], cols[-1]
+    else:
+        groups = np.split(edges, np.flatnonzero(np.diff(edges) > MAX_BAR_GAP) + 1)
+        bars = max(groups, key=len)
+        left, right = bars[0] + 1, bars[-1]
+
+    # Incluir el texto pegado arriba o abajo de las barras
+    band_has_ink = dark[:, left:right + 1].any(axis=1)
+    gap = 0
+    row = bottom + 1
+    while row < dark.shape[0] and gap <= MAX_TEXT_GAP:
+        if band_has_ink[row]:
+            bottom, gap = row, 0
+        else:
+            gap += 1
+        row += 1
+    gap = 0
+    row = top - 1
+    while row >= 0 and gap <= MAX_TEXT_GAP:
+        if band_has_ink[row]:
+            top, gap = row, 0
+        else:
+            gap += 1
+        row -= 1
+
+    return left, top, right, bottom
+
+def trim_barcode_image(img, margin=12, threshold=160, mode="1bit"):
+    """Recortar una imagen PIL ya decodificada al código de barras (más `margin` píxeles).
+
+    `mode` "1bit" la deja en blanco/negro; "palette" en 16 colores que
+    conservan el suavizado del texto. Retorna la imagen, sin codificar.
+    """
+    img = img.convert("L")
+    pixels = np.asarray(img)
+    bbox = find_barcode_bbox(pixels < threshold)
+    if bbox is not None:
+        left, top, right, bottom = bbox
+        height, width = pixels.shape
+        img = img.crop((
+            max(0, left - margin),
+            max(0, top - margin),
+            min(width, right + 1 + margin),
+            min(height, bottom + 1 + margin),
+        ))
+
+    if mode == "1bit":
+        img = img.point(lambda value: 255 if value >= threshold else 0, mode="1")
+    else:
+        img = img.quantize(colors=16)
+    return img
+
+def trim_barcode_png(png_bytes, margin=12, threshold=160, mode="1bit"):
+    """Recortar al código de barras (más `margin` píxeles) y re-codificar compacto"""
+    img = trim_barcode_image(Image.open(io.BytesIO(png_bytes)), margin, threshold, mode)
+    output = io.BytesIO()
+    img.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+def compact_png_batch(pngs, processes=None):
+    """Aplicar trim_barcode_png a muchas imágenes en un pool de procesos, conservando el orden"""
+    if len(pngs) < 2:
+        return [trim_barcode_png(png) for png in pngs]
+    # "spawn": hacer fork de un servidor Streamlit con hilos no es seguro
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        return list(executor.map(trim_barcode_png, pngs, chunksize=16))
@@ -0,0 +1,135 @@
+"""Benchmark sin red de la captura de códigos de barras contra fake_redcap.py.
+
+Levanta un RedCap falso local, apunta app.py hacia él y mide IDs/minuto,
+percentiles de latencia por ID y memoria para cada combinación de motor y
+cantidad de sesiones de Chrome.
+
+Ejemplo: python benchmark.py --ids 100 --engines selenium,api --workers 1,2,4 --latency 0.2
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from fake_redcap import FakeRedcap
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def prepare_workdir(fake):
+    """Directorio temporal con secrets apuntando al servidor falso (y caché aislada)"""
+    workdir = tempfile.mkdtemp(prefix="benchmark_codigos_")
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        f.write(
+            'redcap_username = "benchmark"\n'
+            'redcap_password = "benchmark"\n'
+            'email_sender = "benchmark@localhost"\n'
+            'email_password = "benchmark"\n'
+            f'redcap_api_token = "{fake.api_token}"\n'
+            f'redcap_base_url = "{fake.base_url}"\n'
+            f'redcap_api_url = "{fake.api_url}"\n'
+            f'redcap_timezone = "{fake.timezone.key}"\n'
+            'redcap_barcode_field = "codigo_barras"\n'
+        )
+    return workdir
+
+def load_app(workdir):
+    """Importar app.py con los secrets del directorio de trabajo (sin ejecutar la interfaz)"""
+    os.chdir(workdir)
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    sys.path.insert(0, APP_DIR)
+    return importlib.import_module("app")
+
+def run_config(app, record_ids, engine, num_workers, warm, lean=False, tabs=1):
+    metrics = app.CaptureMetrics()
+    options = {
+        "engine": engine,
+        "num_workers": num_workers,
+        "tabs": tabs,
+        "use_cache": False,
+        "validate_cache": False,
+        "lean": lean,
+    }
+    if not warm and engine == app.ENGINE_SELENIUM:
+        # Arranque en frío: cerrar los drivers que dejó la configuración anterior
+        app.get_driver_pool(app.redcap_username, app.redcap_password, lean=lean, pipelined=tabs > 1).close()
+
+    start = time.perf_counter()
+    images = app.run_capture(record_ids, options, app.save_image_in_memory, metrics=metrics)
+    elapsed = time.perf_counter() - start
+
+    per_record = metrics.per_record_totals()
+    memory = metrics.memory_frame().dropna(subset=["rss_mb"])
+    stages = metrics.summary()
+    return {
+        "motor": engine,
+        "sesiones": num_workers,
+        "pestanas": tabs,
+        "perfil": "liviano" if lean else "normal",
+        "ids": len(record_ids),
+        "capturados": len(images),
+        "segundos": round(elapsed, 2),
+        "ids_por_minuto": round(len(images) / elapsed * 60, 1) if elapsed else None,
+        "p50_id_s": round(per_record.quantile(0.5), 3) if not per_record.empty else None,
+        "p95_id_s": round(per_record.quantile(0.95), 3) if not per_record.empty else None,
+        "rss_driver_max_mb": round(memory["rss_mb"].max(), 1) if not memory.empty else None,
+        "kb_por_pagina": round(metrics.kb_per_page(), 1) if metrics.kb_per_page() is not None else None,
+        "rss_proceso_mb": round(app.process_tree_rss_mb(os.getpid()), 1),
+        "reciclajes": len(metrics.recycles),
+        "etapas": stages.reset_index().to_dict(orient="records"),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ids", type=int, default=50, help="Cantidad de Record IDs por corrida")
+    parser.add_argument("--engines", default="selenium,api", help="Motores separados por comas: selenium, api")
+    parser.add_argument("--workers", default="1,2", help="Sesiones de Chrome a probar, separadas por comas")
+    parser.add_argument("--latency", type=float, default=0.1, help="Segundos por página HTML/API")
+    parser.add_argument("--piping-delay", type=float, default=0.5, help="Segundos hasta que aparece tr#barcode-tr")
+    parser.add_argument("--image-latency", type=float, default=0.02, help="Segundos por imagen o recurso")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Segundos aleatorios extra por respuesta")
+    parser.add_argument("--tabs", default="1", help="Pestañas por sesión (pipeline) a probar, separadas por comas")
+    parser.add_argument("--profiles", default="normal", help="Perfiles de Chrome separados por comas: normal, liviano")
+    parser.add_argument("--warm", action="store_true", help="Reutilizar drivers entre configuraciones")
+    parser.add_argument("--output", help="Guardar los resultados completos en este archivo JSON")
+    args = parser.parse_args()
+
+    fake = FakeRedcap(args.latency, args.piping_delay, args.image_latency, args.jitter)
+    fake.start()
+    app = load_app(prepare_workdir(fake))
+
+    engines = {"selenium": app.ENGINE_SELENIUM, "api": app.ENGINE_API}
+    record_ids = list(range(1, args.ids + 1))
+
+    results = []
+    for engine_key in args.engines.split(","):
+        engine = engines[engine_key.strip()]
+        # El motor API no usa sesiones de Chrome: una sola corrida
+        worker_counts = [int(w) for w in args.workers.split(",")] if engine == app.ENGINE_SELENIUM else [1]
+        # Los perfiles y las pestañas solo cambian Chrome
+        profiles = args.profiles.split(",") if engine == app.ENGINE_SELENIUM else ["normal"]
+        tab_counts = [int(t) for t in args.tabs.split(",")] if engine == app.ENGINE_SELENIUM else [1]
+        for profile in profiles:
+            for num_workers in worker_counts:
+                for tabs in tab_counts:
+                    print(f"▶ {engine} ({profile}) con {num_workers} sesión(es) x {tabs} pestaña(s)...", file=sys.stderr)
+                    lean = profile.strip() == "liviano"
+                    results.append(run_config(app, record_ids, engine, num_workers, args.warm, lean, tabs))
+
+    columns = ["motor", "perfil", "sesiones", "pestanas", "capturados", "segundos", "ids_por_minuto",
+               "p50_id_s", "p95_id_s", "kb_por_pagina", "rss_driver_max_mb", "rss_proceso_mb", "reciclajes"]
+    print(pd.DataFrame(results)[columns].to_string(index=False))
+
+    if args.output:
+        with open(os.path.join(APP_DIR, args.output) if not os.path.isabs(args.output) else args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
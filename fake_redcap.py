@@ -0,0 +1,298 @@
+"""Servidor RedCap falso para medir la captura sin red (usa el tornado que trae Streamlit).
+
+Sirve el flujo de inicio de sesión, record_status_dashboard.php, las páginas
+DataEntry/index.php con su fila tr#barcode-tr (tras un indicador "PIPING DATA")
+y la API de exportación de records, con latencias configurables.
+
+Uso independiente: python fake_redcap.py --port 8080 --latency 0.2
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import tornado.escape
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+from PIL import Image, ImageDraw
+
+REDCAP_PATH = "/redcap_v14.5.11"
+SESSION_COOKIE = "PHPSESSID"
+
+LOGIN_PAGE = """<html><head><title>REDCap</title></head><body>
+<form method="post" action="{action}">
+  <input id="username" name="username" type="text">
+  <input id="password" name="password" type="password">
+  <button type="submit" id="login_btn">Log In</button>
+</form>
+</body></html>"""
+
+DASHBOARD_PAGE = """<html><head><title>Record Status Dashboard</title>{assets}</head><body>
+<table id="record_status_table"><tbody><tr><td>Record Status Dashboard</td></tr></tbody></table>
+</body></html>"""
+
+DATA_ENTRY_PAGE = """<html><head><title>Data Entry</title>{assets}</head><body>
+<div id="piping" style="padding:20px;font-weight:bold">PIPING DATA</div>
+<table id="form_table" style="width:1600px"><tbody>
+  <tr><td>Record ID</td><td>{record_id}</td></tr>
+</tbody></table>
+<script>
+setTimeout(function () {{
+  document.getElementById('piping').style.display = 'none';
+  var row = document.createElement('tr');
+  row.id = 'barcode-tr';
+  row.innerHTML = '<td style="width:1066px;height:110px"><img src="{base}/barcode.png?id={record_id}"></td>' +
+                  '<td>Código de barras de la muestra</td>';
+  document.querySelector('#form_table tbody').appendChild(row);
+}}, {piping_delay_ms});
+</script>
+</body></html>"""
+
+# Recursos "pesados" que una página real de RedCap también carga
+ASSETS = {
+    "redcap.css": ("text/css", "stylesheet"),
+    "form.js": ("application/javascript", "script"),
+    "logo.png": ("image/png", "image"),
+    "fuente.woff2": ("font/woff2", "font"),
+    "analytics.js": ("application/javascript", "script"),
+}
+
+def render_fake_barcode(value, width=1000, height=100):
+    """PNG con barras derivadas del hash del valor (no es un código de barras real)"""
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    bits = "".join(f"{byte:08b}" for byte in hashlib.sha256(str(value).encode()).digest())
+    x = 20
+    for bit in bits:
+        bar_width = 3 if bit == "1" else 1
+        draw.rectangle([x, 10, x + bar_width - 1, height - 25], fill="black")
+        x += bar_width + 2
+        if x >= width - 20:
+            break
+    draw.text((width // 2 - 20, height - 20), str(value), fill="black")
+    output = io.BytesIO()
+    img.save(output, format="PNG")
+    return output.getvalue()
+
+# =========================================
+# Handlers
+# =========================================
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    async def simulate_latency(self, seconds):
+        delay = seconds + random.uniform(0, self.server.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def is_logged_in(self):
+        return self.get_cookie(SESSION_COOKIE) in self.server.sessions
+
+    def render_login(self):
+        self.write(LOGIN_PAGE.format(action=self.request.uri))
+
+    def assets_html(self):
+        tags = []
+        for name, (_, kind) in ASSETS.items():
+            url = f"{REDCAP_PATH}/assets/{name}"
+            if kind == "stylesheet":
+                tags.append(f'<link rel="stylesheet" href="{url}">')
+            elif kind == "script":
+                tags.append(f'<script src="{url}"></script>')
+            elif kind == "image":
+                tags.append(f'<link rel="preload" as="image" href="{url}">')
+            else:
+                tags.append(f'<link rel="preload" as="font" crossorigin href="{url}">')
+        return "\n".join(tags)
+
+class DashboardHandler(BaseHandler):
+    async def get(self):
+        await self.simulate_latency(self.server.latency)
+        if not self.is_logged_in():
+            return self.render_login()
+        self.write(DASHBOARD_PAGE.format(assets=self.assets_html()))
+
+    async def post(self):
+        await self.simulate_latency(self.server.latency)
+        if not self.get_body_argument("username", "") or not self.get_body_argument("password", ""):
+            return self.render_login()
+        session_id = secrets.token_hex(16)
+        self.server.sessions.add(session_id)
+        self.set_cookie(SESSION_COOKIE, session_id)
+        self.redirect(self.request.uri)
+
+class DataEntryHandler(BaseHandler):
+    async def get(self):
+        await self.simulate_latency(self.server.latency)
+        if not self.is_logged_in():
+            return self.render_login()
+        record_id = self.get_query_argument("id")
+        self.server.page_loads += 1
+        self.write(DATA_ENTRY_PAGE.format(
+            assets=self.assets_html(),
+            base=REDCAP_PATH,
+            record_id=tornado.escape.xhtml_escape(record_id),
+            piping_delay_ms=int(self.server.piping_delay * 1000),
+        ))
+
+class BarcodeImageHandler(BaseHandler):
+    async def get(self):
+        await self.simulate_latency(self.server.image_latency)
+        self.set_header("Content-Type", "image/png")
+        self.write(render_fake_barcode(self.get_query_argument("id")))
+
+class AssetHandler(BaseHandler):
+    async def get(self, name):
+        if name not in ASSETS:
+            raise tornado.web.HTTPError(404)
+        await self.simulate_latency(self.server.image_latency)
+        content_type, _ = ASSETS[name]
+        self.set_header("Content-Type", content_type)
+        self.set_header("Cache-Control", "max-age=3600")
+        payload = b"/* relleno */\n" if content_type != "image/png" else render_fake_barcode(name, 200, 60)
+        self.write(payload + b" " * max(0, self.server.asset_kb * 1024 - len(payload)))
+
+class ApiHandler(BaseHandler):
+    async def post(self):
+        await self.simulate_latency(self.server.latency)
+        if self.get_body_argument("token", "") != self.server.api_token:
+            raise tornado.web.HTTPError(403)
+        if self.get_body_argument("content") != "record":
+            raise tornado.web.HTTPError(400)
+
+        record_ids = [
+            value.decode()
+            for key, values in self.request.body_arguments.items()
+            if key.startswith("records[")
+            for value in values
+        ]
+        fields = [
+            value.decode()
+            for key, values in self.request.body_arguments.items()
+            if key.startswith("fields[")
+            for value in values
+        ]
+        self.server.api_requests += 1
+        # Los records que no existen en el proyecto no vienen en la respuesta
+        record_ids = [r for r in record_ids if r not in self.server.missing]
+        since = self.get_body_argument("dateRangeBegin", None)
+        if since:
+            # Como RedCap: la fecha se interpreta en la hora local del servidor
+            since_ts = datetime.strptime(since, "%Y-%m-%d %H:%M:%S").replace(tzinfo=self.server.timezone).timestamp()
+            record_ids = [r for r in record_ids if self.server.modified_at.get(r, 0) >= since_ts]
+
+        rows = [{field: record_id for field in fields or ["record_id"]} for record_id in record_ids]
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(rows))
+
+# =========================================
+# Servidor
+# =========================================
+class FakeRedcap:
+    """Servidor RedCap falso que corre en un hilo propio sobre 127.0.0.1.
+
+    `latency`: segundos por respuesta HTML/API; `piping_delay`: segundos que
+    tarda en aparecer tr#barcode-tr; `image_latency`: segundos por imagen o
+    recurso; `jitter`: segundos aleatorios extra; `asset_kb`: tamaño de cada
+    recurso estático; `timezone`: hora local del servidor, con la que se lee
+    dateRangeBegin (por defecto distinta de la UTC de un contenedor).
+    """
+
+    def __init__(self, latency=0.05, piping_delay=0.3, image_latency=0.0, jitter=0.0,
+                 asset_kb=100, api_token="token-de-prueba", timezone="America/Lima"):
+        self.latency = latency
+        self.piping_delay = piping_delay
+        self.image_latency = image_latency
+        self.jitter = jitter
+        self.asset_kb = asset_kb
+        self.api_token = api_token
+        self.timezone = ZoneInfo(timezone)
+        self.sessions = set()
+        self.modified_at = {}  # record_id -> timestamp de la última modificación
+        self.missing = set()  # record_ids (str) que la API no retorna
+        self.api_requests = 0
+        self.page_loads = 0
+        self.port = None
+        self._loop = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}{REDCAP_PATH}"
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.port}/api/"
+
+    def touch(self, record_id):
+        """Marcar un record como modificado ahora (para probar la invalidación)"""
+        self.modified_at[str(record_id)] = time.time()
+
+    def expire_sessions(self):
+        """Cerrar todas las sesiones (para probar el reinicio de sesión)"""
+        self.sessions.clear()
+
+    def make_app(self):
+        kwargs = {"server": self}
+        return tornado.web.Application([
+            (rf"{REDCAP_PATH}/DataEntry/record_status_dashboard\.php", DashboardHandler, kwargs),
+            (rf"{REDCAP_PATH}/DataEntry/index\.php", DataEntryHandler, kwargs),
+            (rf"{REDCAP_PATH}/barcode\.png", BarcodeImageHandler, kwargs),
+            (rf"{REDCAP_PATH}/assets/(.+)", AssetHandler, kwargs),
+            (r"/api/", ApiHandler, kwargs),
+        ])
+
+    def start(self, port=0):
+        """Iniciar en segundo plano; retorna la URL base (equivalente a redcap_base_url)"""
+        thread = threading.Thread(target=self._run, args=(port,), daemon=True)
+        thread.start()
+        self._ready.wait()
+        return self.base_url
+
+    def _run(self, port):
+        # El log de accesos de tornado satura la salida del benchmark
+        logging.getLogger("tornado.access").setLevel(logging.WARNING)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        sockets = tornado.netutil.bind_sockets(port, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        server = tornado.httpserver.HTTPServer(self.make_app())
+        server.add_sockets(sockets)
+        self._loop = tornado.ioloop.IOLoop.current()
+        self._ready.set()
+        self._loop.start()
+
+    def stop(self):
+        if self._loop:
+            self._loop.add_callback(self._loop.stop)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--piping-delay", type=float, default=0.3)
+    parser.add_argument("--image-latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--asset-kb", type=int, default=100)
+    args = parser.parse_args()
+
+    fake = FakeRedcap(args.latency, args.piping_delay, args.image_latency, args.jitter, args.asset_kb)
+    print(f"redcap_base_url = \"{fake.start(args.port)}\"")
+    print(f"redcap_api_url = \"{fake.api_url}\"")
+    print(f"redcap_api_token = \"{fake.api_token}\"")
+    print(f"redcap_timezone = \"{fake.timezone.key}\"")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
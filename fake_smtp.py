@@ -0,0 +1,126 @@
+"""Servidor SMTP falso (solo biblioteca estándar) para probar el envío de los ZIP sin red.
+
+Acepta EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP y QUIT sin autenticación,
+guarda cada mensaje recibido con el número de la conexión que lo trajo y
+puede cortar la conexión para probar la reconexión.
+
+Uso independiente: python fake_smtp.py --port 2525
+"""
+import argparse
+import email
+import socketserver
+import threading
+import time
+from email import policy
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server.fake
+        connection = server.register_connection()
+        self.reply("220 fake_smtp listo")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb == "MAIL" and server.should_disconnect(connection):
+                # Como un servidor que cerró la conexión por inactividad: sin respuesta
+                return
+            if verb == "EHLO":
+                self.reply("250-fake_smtp")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 fake_smtp")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 Terminar con <CRLF>.<CRLF>")
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    # Quitar el punto extra que el cliente agrega a las líneas que empiezan con "."
+                    lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                server.store(connection, sender, recipients, b"".join(lines))
+                self.reply("250 OK mensaje recibido")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Adiós")
+                return
+            else:
+                self.reply("502 Comando no implementado")
+
+class FakeSmtp:
+    """Servidor SMTP falso en un hilo propio sobre 127.0.0.1.
+
+    `disconnect_after`: tras esa cantidad de mensajes en la primera conexión,
+    el servidor la corta una vez sin responder (para probar la reconexión).
+    """
+
+    def __init__(self, disconnect_after=None):
+        self.disconnect_after = disconnect_after
+        self.messages = []  # [(número de conexión, remitente, destinatarios, email.message.EmailMessage)]
+        self.connections = 0
+        self.disconnects = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def register_connection(self):
+        with self._lock:
+            self.connections += 1
+            return self.connections
+
+    def should_disconnect(self, connection):
+        with self._lock:
+            received = sum(1 for number, *_ in self.messages if number == connection)
+            if self.disconnect_after is not None and not self.disconnects and received >= self.disconnect_after:
+                self.disconnects += 1
+                return True
+            return False
+
+    def store(self, connection, sender, recipients, raw):
+        message = email.message_from_bytes(raw, policy=policy.default)
+        with self._lock:
+            self.messages.append((connection, sender, recipients, message))
+
+    def start(self, port=0):
+        """Iniciar en segundo plano; retorna el puerto"""
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", port), SmtpHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=2525)
+    args = parser.parse_args()
+
+    fake = FakeSmtp()
+    print(f"smtp_host = \"127.0.0.1\"\nsmtp_port = {fake.start(args.port)}\nsmtp_ssl = false")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
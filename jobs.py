@@ -0,0 +1,245 @@
+"""Trabajos de captura en segundo plano con checkpoints en SQLite.
+
+Cada trabajo guarda su estado, el estado de cada Record ID y las imágenes ya
+capturadas, así que sobrevive a un refresco del navegador o a un reinicio del
+contenedor y se reanuda desde el último ID terminado.
+
+Uso del worker: python jobs.py <job_id>
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from contextlib import closing
+
+# Ruta por defecto; app.get_job_store() la reemplaza con el secreto jobs_db_path
+JOBS_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trabajos_captura.sqlite3")
+JOBS_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trabajos_captura.log")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    email_receiver TEXT,
+    options TEXT NOT NULL,
+    pid INTEGER,
+    error TEXT,
+    emailed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    record_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    image BLOB,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS job_items_status ON job_items (job_id, status);
+"""
+
+# Estados de un trabajo
+QUEUED = "en cola"
+RUNNING = "en ejecución"
+DONE = "terminado"
+FAILED = "fallido"
+
+# =========================================
+# Almacén de Trabajos
+# =========================================
+class JobStore:
+    """Estado persistente de los trabajos de captura (seguro entre procesos e hilos)"""
+
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create_job(self, record_ids, email_receiver, options):
+        """Registrar un trabajo nuevo con todos sus IDs pendientes; retorna su id"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (created_at, updated_at, status, email_receiver, options) VALUES (?, ?, ?, ?, ?)",
+                (now, now, QUEUED, email_receiver, json.dumps(options)),
+            )
+            job_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO job_items (job_id, position, record_id) VALUES (?, ?, ?)",
+                [(job_id, position, str(id_val)) for position, id_val in enumerate(record_ids)],
+            )
+        return job_id
+
+    def get_job(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        return job
+
+    def set_status(self, job_id, status, pid=None, error=None):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, pid = COALESCE(?, pid), error = ?, updated_at = ? WHERE id = ?",
+                (status, pid, error, time.time(), job_id),
+            )
+
+    def mark_emailed(self, job_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE jobs SET emailed = 1 WHERE id = ?", (job_id,))
+
+    def record_ids(self, job_id):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT record_id FROM job_items WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        return [row["record_id"] for row in rows]
+
+    def pending_ids(self, job_id):
+        """IDs aún sin imagen (pendientes o fallidos), en el orden original"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT record_id FROM job_items WHERE job_id = ? AND status != 'done' ORDER BY position",
+                (job_id,),
+            ).fetchall()
+        return [row["record_id"] for row in rows]
+
+    def mark_done(self, job_id, record_id, png_bytes):
+        """Checkpoint de un ID: guardar su imagen para no volver a capturarlo"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE job_items SET status = 'done', image = ? WHERE job_id = ? AND record_id = ?",
+                (png_bytes, job_id, str(record_id)),
+            )
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def mark_pending_failed(self, job_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE job_items SET status = 'failed' WHERE job_id = ? AND status = 'pending'", (job_id,)
+            )
+
+    def progress(self, job_id):
+        """Cantidad de IDs por estado: {'pending': n, 'done': n, 'failed': n}"""
+        counts = {"pending": 0, "done": 0, "failed": 0}
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) AS n FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        for row in rows:
+            counts[row["status"]] = row["n"]
+        return counts
+
+    def images(self, job_id):
+        """Imágenes capturadas como tuplas (nombre_archivo, bytes_png), en el orden original"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT record_id, image FROM job_items WHERE job_id = ? AND status = 'done' ORDER BY position",
+                (job_id,),
+            ).fetchall()
+        return [(f"{row['record_id']}.png", row["image"]) for row in rows]
+
+    def interrupted_jobs(self):
+        """Trabajos en cola o en ejecución cuyo proceso worker ya no existe"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, pid FROM jobs WHERE status IN (?, ?) ORDER BY id", (QUEUED, RUNNING)
+            ).fetchall()
+        return [row["id"] for row in rows if not is_process_alive(row["pid"], row["id"])]
+
+def is_process_alive(pid, job_id=None):
+    """¿Sigue corriendo el worker con este PID?
+
+    Tras reiniciar el contenedor los PID se reutilizan, así que además del PID
+    se exige que el proceso sea `jobs.py` (y, con `job_id`, el de ese trabajo).
+    """
+    if not pid:
+        return False
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Un hijo terminado que nadie esperó sigue existiendo como zombie
+            if f.read().split(")")[-1].split()[0] == "Z":
+                return False
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            args = [arg.decode(errors="replace") for arg in f.read().split(b"\0") if arg]
+    except OSError:
+        return False
+    if not any(os.path.basename(arg) == "jobs.py" for arg in args):
+        return False
+    return job_id is None or args[-1] == str(job_id)
+
+# =========================================
+# Proceso Worker
+# =========================================
+def start_worker(job_id, store):
+    """Lanzar el worker de un trabajo en un proceso independiente de Streamlit"""
+    with open(JOBS_LOG_PATH, "ab") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(job_id)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    store.set_status(job_id, QUEUED, pid=process.pid)
+    return process.pid
+
+def email_job(store, job_id):
+    """Enviar por email las imágenes capturadas del trabajo, una sola vez.
+
+    Retorna True si el email quedó enviado (ahora o antes).
+    """
+    import app  # Importación diferida: app importa este módulo
+
+    job = store.get_job(job_id)
+    if job["emailed"]:
+        return True
+    images = store.images(job_id)
+    if not (job["email_receiver"] and images):
+        return False
+    attachments = app.register_capture(images, job["options"].get("manifest_csv", False))
+    zip_parts = app.create_zip_parts(attachments, store.record_ids(job_id), in_memory=True)
+    if not app.send_email_with_zip(store.record_ids(job_id), images, job["email_receiver"], in_memory=True,
+                                   zip_parts=zip_parts):
+        return False
+    store.mark_emailed(job_id)
+    # Desde la creación del trabajo: lo modificado durante la captura entra en la próxima entrega
+    app.register_delivery(images, job["email_receiver"], job["created_at"])
+    return True
+
+def run_job(job_id):
+    """Capturar los IDs pendientes del trabajo, guardando cada imagen al terminarla"""
+    import app  # Importación diferida: app importa este módulo
+
+    store = app.get_job_store()
+    store.set_status(job_id, RUNNING, pid=os.getpid())
+    try:
+        job = store.get_job(job_id)
+        pending_ids = store.pending_ids(job_id)
+
+        def save_checkpoint(id_val, png_bytes):
+            store.mark_done(job_id, id_val, png_bytes)
+            return app.save_image_in_memory(id_val, png_bytes)
+
+        if pending_ids:
+            app.run_capture(pending_ids, job["options"], save_checkpoint)
+        store.mark_pending_failed(job_id)
+        email_job(store, job_id)
+        store.set_status(job_id, DONE)
+    except BaseException as e:
+        store.set_status(job_id, FAILED, error=str(e) or type(e).__name__)
+        raise
+
+if __name__ == "__main__":
+    run_job(int(sys.argv[1]))
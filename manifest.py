@@ -0,0 +1,94 @@
+"""Manifiesto local de los Record IDs capturados y entregados (modo delta).
+
+Guarda, por proyecto y evento, cuándo se capturó y cuándo se entregó cada
+Record ID, y un hash de su imagen. Con la fecha de entrega como marca, una
+consulta a la API de RedCap (dateRangeBegin) dice qué records cambiaron
+desde entonces, así que cada envío solo captura los nuevos o modificados.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+MANIFEST_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifiesto_entregas.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    project_id INTEGER NOT NULL,
+    event_id INTEGER NOT NULL,
+    record_id TEXT NOT NULL,
+    captured_at REAL,
+    delivered_at REAL,
+    email_receiver TEXT,
+    image_sha1 TEXT,
+    PRIMARY KEY (project_id, event_id, record_id)
+);
+"""
+
+# Máximo de parámetros por consulta IN (SQLite acepta 999 en versiones antiguas)
+QUERY_BATCH = 500
+
+class DeliveryManifest:
+    """Capturas y entregas por Record ID de un proyecto y evento (seguro entre procesos)"""
+
+    def __init__(self, project_id, event_id, path=MANIFEST_DB_PATH):
+        self.project_id = project_id
+        self.event_id = event_id
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def entries(self, record_ids):
+        """{record_id: fila} de los IDs que ya están en el manifiesto"""
+        keys = [str(id_val) for id_val in record_ids]
+        found = {}
+        with closing(self._connect()) as conn:
+            for start in range(0, len(keys), QUERY_BATCH):
+                batch = keys[start:start + QUERY_BATCH]
+                rows = conn.execute(
+                    f"SELECT * FROM manifest WHERE project_id = ? AND event_id = ? "
+                    f"AND record_id IN ({', '.join('?' * len(batch))})",
+                    (self.project_id, self.event_id, *batch),
+                ).fetchall()
+                found.update((row["record_id"], dict(row)) for row in rows)
+        return found
+
+    def rows(self):
+        """Todas las filas del proyecto y evento, ordenadas por Record ID"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM manifest WHERE project_id = ? AND event_id = ? ORDER BY CAST(record_id AS INTEGER)",
+                (self.project_id, self.event_id),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_captured(self, images, when=None):
+        """Registrar capturas: `images` es un dict {record_id: bytes_png}"""
+        when = when or time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO manifest (project_id, event_id, record_id, captured_at, image_sha1) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (project_id, event_id, record_id) "
+                "DO UPDATE SET captured_at = excluded.captured_at, image_sha1 = excluded.image_sha1",
+                [
+                    (self.project_id, self.event_id, str(id_val), when, hashlib.sha1(png_bytes).hexdigest())
+                    for id_val, png_bytes in images.items()
+                ],
+            )
+
+    def mark_delivered(self, record_ids, email_receiver, when):
+        """Registrar la entrega; `when` es el inicio del envío, así lo modificado durante la captura se vuelve a enviar"""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "UPDATE manifest SET delivered_at = ?, email_receiver = ? "
+                "WHERE project_id = ? AND event_id = ? AND record_id = ?",
+                [(when, email_receiver, self.project_id, self.event_id, str(id_val)) for id_val in record_ids],
+            )
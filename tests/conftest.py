@@ -0,0 +1,36 @@
+"""Fixtures comunes: app.py importado con secrets de prueba en un directorio temporal."""
+import importlib
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from fake_redcap import FakeRedcap  # noqa: E402
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """Módulo app con secrets mínimos; el directorio de trabajo queda en un temporal"""
+    workdir = tmp_path_factory.mktemp("app")
+    (workdir / ".streamlit").mkdir()
+    (workdir / ".streamlit" / "secrets.toml").write_text(
+        'redcap_username = "prueba"\n'
+        'redcap_password = "prueba"\n'
+        'email_sender = "remitente@localhost"\n'
+        'email_password = "prueba"\n'
+        f'manifest_db_path = "{workdir / "manifiesto.sqlite3"}"\n'
+        f'jobs_db_path = "{workdir / "trabajos.sqlite3"}"\n'
+    )
+    os.chdir(workdir)
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    return importlib.import_module("app")
+
+@pytest.fixture(scope="session")
+def redcap():
+    """RedCap falso sin latencia, con una zona horaria distinta a la del contenedor"""
+    fake = FakeRedcap(latency=0.0, piping_delay=0.0, timezone="America/Lima")
+    fake.start()
+    yield fake
+    fake.stop()
@@ -0,0 +1,43 @@
+"""Cupo de Chrome compartido entre procesos (archivos de cupo con flock y PID)."""
+import fcntl
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+
+HOLD_SLOT = """
+import sys, time
+sys.path.insert(0, {app_dir!r})
+import app
+admission = app.BrowserAdmission(2, slots_dir={slots_dir!r})
+print(admission.reserve(), flush=True)
+time.sleep(60)
+"""
+
+def test_slots_of_other_processes_count_until_they_die(app, tmp_path):
+    admission = app.BrowserAdmission(2, slots_dir=str(tmp_path))
+    code = HOLD_SLOT.format(app_dir=APP_DIR, slots_dir=str(tmp_path))
+    # Desde el directorio con los secrets de prueba (ver conftest)
+    holder = subprocess.Popen([sys.executable, "-c", code], cwd=os.getcwd(), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True)
+    try:
+        assert holder.stdout.readline().strip() == "True"
+        assert admission.live_instances() == 1
+        assert admission.reserve()
+        assert admission.live_instances() == 2
+        assert not admission.reserve()
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert admission.live_instances() == 1
+    assert admission.reserve()
+
+def test_counting_never_locks_a_free_slot(app, tmp_path, monkeypatch):
+    admission = app.BrowserAdmission(2, slots_dir=str(tmp_path))
+    locked = []
+    monkeypatch.setattr(fcntl, "flock", lambda *args: locked.append(args))
+
+    assert admission.live_instances() == 0
+    assert locked == []
@@ -0,0 +1,74 @@
+"""Motor sin navegador (API de RedCap + PIL) contra el RedCap falso de fake_redcap.py."""
+import io
+
+import pytest
+import requests
+from PIL import Image
+
+@pytest.fixture
+def api(app, redcap, monkeypatch):
+    monkeypatch.setattr(app, "REDCAP_API_URL", redcap.api_url)
+    monkeypatch.setattr(app, "REDCAP_BARCODE_FIELD", "codigo_barras")
+    # Reintentos sin esperas para que las pruebas no duerman
+    monkeypatch.setitem(app.RETRY_POLICIES, "api", {"attempts": 4, "multiplier": 0.0, "max_wait": 0.0})
+    redcap.api_requests = 0
+    redcap.missing.clear()
+    yield redcap
+    redcap.missing.clear()
+
+@pytest.fixture
+def posts(monkeypatch):
+    """Payloads enviados a la API (en orden)"""
+    sent = []
+    original = requests.post
+
+    def post(url, data=None, **kwargs):
+        sent.append(dict(data))
+        return original(url, data=data, **kwargs)
+
+    monkeypatch.setattr(requests, "post", post)
+    return sent
+
+def test_more_than_one_batch_is_split_in_posts_of_500(app, api):
+    record_ids = list(range(1, 1202))
+
+    values = app.fetch_barcode_values(record_ids, api.api_token)
+
+    assert api.api_requests == 3
+    assert values == {str(id_val): str(id_val) for id_val in record_ids}
+
+def test_ids_missing_from_the_api_are_reported_and_skipped(app, api):
+    api.missing.update({"2", "4"})
+
+    images = app.download_barcode_images_api([1, 2, 3, 4], api.api_token, save=app.save_image_in_memory)
+
+    assert [name for name, _ in images] == ["1.png", "3.png"]
+
+def test_request_errors_are_retried(app, api, posts, monkeypatch):
+    failures = iter([requests.ConnectionError("conexión rechazada")])
+    post = requests.post
+
+    def flaky_post(*args, **kwargs):
+        error = next(failures, None)
+        if error:
+            raise error
+        return post(*args, **kwargs)
+
+    monkeypatch.setattr(requests, "post", flaky_post)
+
+    assert app.fetch_barcode_values([1, 2], api.api_token) == {"1": "1", "2": "2"}
+    assert len(posts) == 1  # El primer intento falló antes de llegar al servidor
+    assert api.api_requests == 1
+
+def test_record_id_as_barcode_field_is_requested_once(app, api, posts, monkeypatch):
+    monkeypatch.setattr(app, "REDCAP_BARCODE_FIELD", "record_id")
+
+    assert app.fetch_barcode_values([7], api.api_token) == {"7": "7"}
+    assert [key for key in posts[0] if key.startswith("fields")] == ["fields[0]"]
+
+def test_images_match_the_configured_crop_size(app, api):
+    images = app.download_barcode_images_api([5, 123456789], api.api_token, save=app.save_image_in_memory)
+
+    assert len(images) == 2
+    for _, png in images:
+        assert Image.open(io.BytesIO(png)).size == app.BARCODE_IMAGE_SIZE
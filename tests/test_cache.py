@@ -0,0 +1,23 @@
+"""Caché de imágenes compartida por varios procesos (una instancia de BarcodeCache por proceso)."""
+
+def test_size_limit_is_shared_by_instances_on_the_same_folder(app, tmp_path):
+    first = app.BarcodeCache(str(tmp_path), 19, 59, max_bytes=1000)
+    second = app.BarcodeCache(str(tmp_path), 19, 59, max_bytes=1000)
+
+    first.put(1, b"a" * 600)
+    second.put(2, b"b" * 600)
+
+    assert second.stats() == first.stats() == {"imagenes": 1, "mb": 600 / (1024 * 1024)}
+    assert first.get(1) is None
+    assert first.get(2) == b"b" * 600
+
+def test_images_written_by_another_instance_are_hits(app, tmp_path):
+    first = app.BarcodeCache(str(tmp_path), 19, 59, max_bytes=1000)
+    second = app.BarcodeCache(str(tmp_path), 19, 59, max_bytes=1000)
+
+    second.put(7, b"png")
+
+    assert first.get(7) == b"png"
+    assert first.captured_at(7) is not None
+    second.invalidate(7)
+    assert first.get(7) is None
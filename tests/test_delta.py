@@ -0,0 +1,108 @@
+"""Modo delta contra el RedCap falso de fake_redcap.py (con una zona horaria distinta a la del contenedor)."""
+import os
+import time
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from manifest import DeliveryManifest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+@pytest.fixture
+def api(app, redcap, monkeypatch):
+    monkeypatch.setattr(app, "REDCAP_API_URL", redcap.api_url)
+    monkeypatch.setattr(app, "REDCAP_TIMEZONE", redcap.timezone)
+    # El contenedor en UTC y RedCap en Lima: el caso en que la hora local del contenedor falla
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield redcap
+    monkeypatch.undo()
+    time.tzset()
+
+@pytest.fixture
+def manifest(tmp_path):
+    return DeliveryManifest(19, 59, str(tmp_path / "manifiesto.sqlite3"))
+
+def deliver(manifest, record_ids, when):
+    manifest.mark_captured({str(id_val): f"png {id_val}".encode() for id_val in record_ids}, when)
+    manifest.mark_delivered(record_ids, "destinatario@localhost", when)
+
+def test_new_and_changed_records_are_selected(app, api, manifest):
+    now = time.time()
+    deliver(manifest, [1, 2, 3], now - 3600)
+    api.modified_at.update({"2": now - 1800, "3": now - 7200})  # 2 cambió tras la entrega; 3, antes
+
+    statuses = app.classify_delta([1, 2, 3, 4], manifest, api.api_token)
+
+    assert statuses == {
+        "1": app.DELTA_UNCHANGED,
+        "2": app.DELTA_CHANGED,
+        "3": app.DELTA_UNCHANGED,
+        "4": app.DELTA_NEW,
+    }
+
+def test_each_delivery_is_checked_from_its_own_date(app, api, manifest):
+    now = time.time()
+    deliver(manifest, [1], now - 7200)
+    deliver(manifest, [2], now - 600)
+    api.modified_at.update({"1": now - 3600, "2": now - 3600})  # Después de la entrega de 1, antes de la de 2
+
+    statuses = app.classify_delta([1, 2], manifest, api.api_token)
+
+    assert statuses == {"1": app.DELTA_CHANGED, "2": app.DELTA_UNCHANGED}
+
+def test_without_token_only_new_records_are_selected(app, manifest):
+    deliver(manifest, [1], time.time() - 3600)
+
+    assert app.classify_delta([1, 2], manifest) == {"1": app.DELTA_UNCHANGED, "2": app.DELTA_NEW}
+
+def test_captured_but_undelivered_records_stay_new(app, manifest):
+    manifest.mark_captured({"1": b"png"})
+
+    assert app.classify_delta([1], manifest) == {"1": app.DELTA_NEW}
+
+def test_download_only_run_marks_delivery_on_download(app, redcap, tmp_path):
+    """Sin email, capturar no es entregar: solo la descarga del ZIP anota la entrega"""
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    for key, value in {
+        "redcap_username": "prueba",
+        "redcap_password": "prueba",
+        "email_sender": "remitente@localhost",
+        "email_password": "prueba",
+        "redcap_api_token": redcap.api_token,
+        "redcap_base_url": redcap.base_url,
+        "redcap_api_url": redcap.api_url,
+        "redcap_barcode_field": "codigo_barras",
+        "redcap_timezone": redcap.timezone.key,
+        "manifest_db_path": app.get_delivery_manifest().path,
+        # main() relanza los trabajos interrumpidos: nunca los de la base real
+        "jobs_db_path": str(tmp_path / "trabajos.sqlite3"),
+    }.items():
+        at.secrets[key] = value
+    at.run()
+    at.text_input[0].set_value("101-103").run()
+    [radio for radio in at.radio if radio.label == "Motor de captura"][0].set_value(app.ENGINE_API)
+    for checkbox in at.checkbox:
+        if checkbox.label.startswith(("Pipeline en memoria", "Modo delta", "Adjuntar manifiesto")):
+            checkbox.check()
+    at.run()
+    [button for button in at.button if button.label.startswith("🚀")][0].click().run()
+
+    assert not at.exception
+    manifest = app.get_delivery_manifest()
+    entries = manifest.entries([101, 102, 103])
+    assert sorted(entries) == ["101", "102", "103"]
+    assert all(entry["delivered_at"] is None for entry in entries.values())
+
+    (zip_filename, zip_bytes), = at.session_state["partes_zip"]
+    app.register_zip_download(zip_bytes, at.session_state["inicio_captura"])
+
+    entries = manifest.entries([101, 102, 103])
+    assert {entry["email_receiver"] for entry in entries.values()} == {app.DELIVERY_DOWNLOAD}
+    assert app.classify_delta([101, 102, 103, 104], manifest) == {
+        "101": app.DELTA_UNCHANGED,
+        "102": app.DELTA_UNCHANGED,
+        "103": app.DELTA_UNCHANGED,
+        "104": app.DELTA_NEW,
+    }
@@ -0,0 +1,68 @@
+"""Envío de los ZIP por partes contra el servidor SMTP falso de fake_smtp.py."""
+import os
+import queue
+
+import pytest
+
+from fake_smtp import FakeSmtp
+
+@pytest.fixture
+def smtp_server(app, monkeypatch, request):
+    fake = FakeSmtp(**getattr(request, "param", {}))
+    monkeypatch.setattr(app, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(app, "SMTP_PORT", fake.start())
+    monkeypatch.setattr(app, "SMTP_SSL", False)
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def images():
+    # Bytes aleatorios: no se comprimen, como los PNG
+    return [(f"{id_val}.png", os.urandom(100 * 1024)) for id_val in range(1, 11)]
+
+def send(app, zip_parts, total_images):
+    events = queue.Queue()
+    app.send_zip_parts(zip_parts, "destinatario@localhost", total_images, events)
+    results = []
+    while True:
+        event = events.get_nowait()
+        if event[0] is None:
+            return results, event[2]
+        results.append(event)
+
+def attachment_names(message):
+    return [part.get_filename() for part in message.iter_attachments()]
+
+def test_zip_parts_stay_under_email_max_zip_mb(app, images, monkeypatch):
+    monkeypatch.setattr(app, "EMAIL_MAX_ZIP_MB", 0.35)
+    parts = app.create_zip_parts(images, list(range(1, 11)), in_memory=True)
+
+    assert len(parts) == 4
+    assert all(len(data) <= 0.35 * 1024 * 1024 for _, data in parts)
+    assert [name for name, _ in parts][0].endswith("_parte1de4.zip")
+
+def test_all_parts_sent_over_one_connection(app, images, smtp_server, monkeypatch):
+    monkeypatch.setattr(app, "EMAIL_MAX_ZIP_MB", 0.35)
+    parts = app.create_zip_parts(images, list(range(1, 11)), in_memory=True)
+
+    results, all_sent = send(app, parts, len(images))
+
+    assert all_sent
+    assert smtp_server.connections == 1
+    assert [attachment_names(message) for *_, message in smtp_server.messages] == [[name] for name, _ in parts]
+    assert [state for _, state, _ in results].count("enviada") == len(parts)
+    assert "(parte 2 de 4)" in smtp_server.messages[1][3]["Subject"]
+
+@pytest.mark.parametrize("smtp_server", [{"disconnect_after": 1}], indirect=True)
+def test_reconnects_once_when_server_disconnects(app, images, smtp_server, monkeypatch):
+    monkeypatch.setattr(app, "EMAIL_MAX_ZIP_MB", 0.35)
+    parts = app.create_zip_parts(images, list(range(1, 11)), in_memory=True)
+
+    results, all_sent = send(app, parts, len(images))
+
+    assert all_sent
+    assert smtp_server.disconnects == 1
+    assert smtp_server.connections == 2
+    # La parte cortada se reintenta por la conexión nueva, sin duplicados
+    assert [connection for connection, *_ in smtp_server.messages] == [1, 2, 2, 2]
+    assert not [event for event in results if event[1] == "error"]
@@ -0,0 +1,32 @@
+"""Recorte de las capturas: el modo compacto en un solo paso da lo mismo que recortar y compactar por separado."""
+import io
+
+from PIL import Image
+
+from barcode_images import trim_barcode_png
+
+def row_screenshot(app):
+    """Captura sintética de la fila tr#barcode-tr: RGBA, con el código en los 2/3 izquierdos"""
+    barcode = Image.open(io.BytesIO(app.render_barcode_png("123456"))).convert("RGBA")
+    row = Image.new("RGBA", (barcode.width * 3 // 2, barcode.height), "white")
+    row.paste(barcode, (0, 0))
+    output = io.BytesIO()
+    row.save(output, format="PNG")
+    return output.getvalue()
+
+def test_compact_crop_matches_crop_then_trim(app):
+    screenshot = row_screenshot(app)
+
+    two_steps = Image.open(io.BytesIO(trim_barcode_png(app.crop_barcode_png(screenshot))))
+    one_step = Image.open(io.BytesIO(app.crop_barcode_png(screenshot, compact=True)))
+
+    assert one_step.mode == two_steps.mode == "1"
+    assert one_step.size == two_steps.size
+    assert list(one_step.getdata()) == list(two_steps.getdata())
+
+def test_plain_crop_keeps_the_left_two_thirds(app):
+    screenshot = row_screenshot(app)
+
+    cropped = Image.open(io.BytesIO(app.crop_barcode_png(screenshot)))
+
+    assert cropped.size == app.BARCODE_IMAGE_SIZE
@@ -0,0 +1,44 @@
+"""Trabajos en segundo plano: reintentar solo el email cuando el SMTP falló."""
+import socket
+
+import pytest
+
+import jobs
+from fake_smtp import FakeSmtp
+
+@pytest.fixture
+def store(tmp_path):
+    return jobs.JobStore(str(tmp_path / "trabajos.sqlite3"))
+
+@pytest.fixture
+def finished_job(store):
+    job_id = store.create_job([1, 2], "destinatario@localhost", {})
+    for id_val in (1, 2):
+        store.mark_done(job_id, id_val, f"png {id_val}".encode())
+    store.set_status(job_id, jobs.DONE)
+    return job_id
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_email_is_retried_without_recapturing(app, store, finished_job, monkeypatch):
+    monkeypatch.setattr(app, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(app, "SMTP_SSL", False)
+    monkeypatch.setattr(app, "SMTP_PORT", closed_port())
+
+    assert not jobs.email_job(store, finished_job)
+    assert not store.get_job(finished_job)["emailed"]
+
+    smtp = FakeSmtp()
+    monkeypatch.setattr(app, "SMTP_PORT", smtp.start())
+    try:
+        assert jobs.email_job(store, finished_job)
+        assert jobs.email_job(store, finished_job)  # Ya enviado: no se repite
+    finally:
+        smtp.stop()
+
+    assert store.get_job(finished_job)["emailed"]
+    assert len(smtp.messages) == 1
+    assert store.get_job(finished_job)["status"] == jobs.DONE
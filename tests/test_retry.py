@@ -0,0 +1,37 @@
+"""Políticas de reintento: los errores de un Chrome o una sesión perdidos no se reintentan."""
+import pytest
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchWindowException,
+    TimeoutException,
+    WebDriverException,
+)
+
+@pytest.fixture(autouse=True)
+def no_waits(app, monkeypatch):
+    monkeypatch.setitem(app.RETRY_POLICIES, "navegar", {"attempts": 3, "multiplier": 0.0, "max_wait": 0.0})
+
+def attempts_until_raised(app, error):
+    calls = 0
+    with pytest.raises(type(error)):
+        for attempt in app.retrying("navegar"):
+            with attempt:
+                calls += 1
+                raise error
+    return calls
+
+@pytest.mark.parametrize("error", [
+    InvalidSessionIdException("invalid session id"),
+    NoSuchWindowException("no such window: target window already closed"),
+    WebDriverException("unknown error: chrome not reachable"),
+    WebDriverException("disconnected: not connected to DevTools"),
+])
+def test_session_loss_is_not_retried(app, error):
+    assert attempts_until_raised(app, error) == 1
+
+@pytest.mark.parametrize("error", [
+    TimeoutException("timeout: Timed out receiving message from renderer"),
+    WebDriverException("unknown error: net::ERR_CONNECTION_RESET"),
+])
+def test_transient_errors_are_retried(app, error):
+    assert attempts_until_raised(app, error) == 3